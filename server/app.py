@@ -1,5 +1,6 @@
-import logging
 import time
+import hashlib
+import logging
 from urllib.parse import urlencode
 from flask import (
     Flask,
@@ -20,8 +21,9 @@ import git_fs
 import git_pr
 import fs
 import permissions
-from segment_updates import update_segment
+from segment_updates import update_segment, segment_writer
 from search import search
+from util import profiling
 
 app = Flask(__name__)
 
@@ -40,8 +42,14 @@ def segments(long_id):
     print(user)
     root = request.args.get("root")
     tertiary = request.args.get("tertiary")
-    result = fs.get_data(long_id, user=user, root=root, tertiary=tertiary)
-    return jsonify(result)
+    etag = make_etag(long_id, root, tertiary, user["login"], fs.get_data_version(long_id))
+    if etag in request.if_none_match:
+        return not_modified(etag)
+    result, segment_ids, columns = fs.get_data_columns(long_id, user=user, root=root, tertiary=tertiary)
+    response = app.response_class(
+        fs.iter_data_json(result, segment_ids, columns), mimetype="application/json"
+    )
+    return with_etag(response, etag)
 
 
 @app.route("/api/segment/", methods=["POST"])
@@ -55,12 +63,38 @@ def update():
 @app.route("/api/nav/")
 def nav():
     user = get_user_details()
-    return jsonify(fs.get_condensed_tree(["translation"], user=user))
+    path = ["translation"]
+    etag = make_etag(user["login"], fs.get_nav_version(), fs.get_nav_generation(path, user))
+    if etag in request.if_none_match:
+        return not_modified(etag)
+    return with_etag(jsonify(fs.get_condensed_tree(path, user=user)), etag)
 
 
 @app.route("/api/problems/")
 def problems():
-    return jsonify(problemsLog.load())
+    etag = make_etag(problemsLog.get_version())
+    if etag in request.if_none_match:
+        return not_modified(etag)
+    return with_etag(jsonify(problemsLog.load()), etag)
+
+
+def make_etag(*parts):
+    """
+    Returns a strong ETag for a response determined by parts, which
+    should capture every version the response depends on
+    """
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def with_etag(response, etag):
+    response.set_etag(etag)
+    # Let the client keep the response but revalidate it every time
+    response.cache_control.no_cache = True
+    return response
+
+
+def not_modified(etag):
+    return with_etag(app.response_class(status=304), etag)
 
 
 @app.route("/api/tm/")
@@ -123,6 +157,32 @@ def publish_request():
     result = git_fs.create_publish_request(path, user)
     return jsonify(result)
 
+@app.route("/api/profile/", methods=["GET", "POST"])
+def profile():
+    user = get_user_details()
+    if user["login"] not in config.ADMIN_LOGINS:
+        return "Forbidden", 403
+    if request.method == "POST":
+        data = request.get_json(silent=True) or {}
+        profiling.configure(enabled=data.get("enabled"), sample_rate=data.get("sample_rate"))
+        if data.get("reset"):
+            profiling.reset()
+    return jsonify({
+        "enabled": profiling.enabled,
+        "sample_rate": profiling.sample_rate,
+        "stats": profiling.report(),
+    })
+
+@app.route("/api/status/")
+def status():
+    user = get_user_details()
+    if user["login"] not in config.ADMIN_LOGINS:
+        return "Forbidden", 403
+    return jsonify({
+        "commit_queue": git_fs.commit_queue.get_stats(),
+        "webhook_queue": git_fs.webhook_queue.get_stats(),
+    })
+
 @app.route("/api/webhook", methods=["POST"])
 def webhook():
     data = request.get_json()
@@ -259,3 +319,5 @@ def init():
 
 
 init()
+segment_writer.recover()
+git_fs.webhook_queue.recover()
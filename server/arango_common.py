@@ -1,15 +1,98 @@
+import time
 import pathlib
 import importlib
+import threading
+from collections import Counter
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from arango import ArangoClient
 from arango.client import StandardDatabase
+from arango.http import HTTPClient
+from arango.exceptions import ArangoServerError
+from arango.response import Response
+from config import config
 
-from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures import ThreadPoolExecutor, wait
 
 MIGRATIONS_DIR = pathlib.Path(__file__).parent / 'migrations'
 
-def get_db():
-    client = ArangoClient()
-    return client.db(username="bilara", password="bilara", name="bilara")
+
+class PooledHTTPClient(HTTPClient):
+    """
+    HTTP client for ArangoClient which keeps connections alive in a pool
+    shared by every thread
+
+    Each thread (or greenlet, under gevent) gets its own requests session,
+    since sessions aren't safe to share, but they all send through the
+    same adapter and so reuse the same connections.
+    """
+    def __init__(self, pool_size):
+        self._adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            # Only requests which never reached ArangoDB are retried here.
+            # Error responses are returned for python-arango to raise as
+            # ArangoServerError, and BulkImporter retries transient ones
+            max_retries=Retry(total=3, read=0, status=0, backoff_factor=0.1),
+        )
+        self._local = threading.local()
+
+    def get_session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            session.mount('http://', self._adapter)
+            session.mount('https://', self._adapter)
+        return session
+
+    def create_session(self, host):
+        return self.get_session()
+
+    def send_request(self, session, method, url, params=None, data=None, headers=None, auth=None):
+        response = self.get_session().request(
+            method=method,
+            url=url,
+            params=params,
+            data=data,
+            headers=headers,
+            auth=auth,
+        )
+        return Response(
+            method=response.request.method,
+            url=response.url,
+            headers=response.headers,
+            status_code=response.status_code,
+            status_text=response.reason,
+            raw_body=response.text,
+        )
+
+
+_clients = {}
+_databases = {}
+_clients_lock = threading.Lock()
+
+def get_client(hosts=None):
+    """
+    Returns the ArangoClient for hosts, shared by the whole process
+    """
+    hosts = hosts or config.get('ARANGO_HOSTS', 'http://127.0.0.1:8529')
+    with _clients_lock:
+        client = _clients.get(hosts)
+        if client is None:
+            http_client = PooledHTTPClient(config.get('ARANGO_POOL_SIZE', 10))
+            client = _clients[hosts] = ArangoClient(hosts=hosts, http_client=http_client)
+        return client
+
+def get_db(name=None):
+    name = name or config.ARANGO_DB_NAME
+    with _clients_lock:
+        db = _databases.get(name)
+    if db is None:
+        db = get_client().db(name, username=config.ARANGO_USER, password=config.ARANGO_PASSWORD)
+        with _clients_lock:
+            db = _databases.setdefault(name, db)
+    return db
 
 def run_migrations():
     db = get_db()
@@ -47,20 +130,112 @@ def run_migrations():
         print(f'No new migrations.')
 
 
-_executor = ThreadPoolExecutor(max_workers=4)
-_limit = 4
-_futures = set()
+class BulkImporter:
+    """
+    Imports batches of documents in the background
 
-def import_background(collection, docs):
+    At most max_in_flight batches are queued or importing at once, and
+    submitting another blocks until one finishes, so a producer can't get
+    ahead of ArangoDB. Batches failing with transient errors are retried
+    with backoff. Throughput and errors are collected for get_stats.
+    """
+    TRANSIENT_HTTP_CODES = {429, 500, 502, 503, 504}
 
-    def error_handler(future):
-        result = future.result()
-        if result["errors"] > 0:
-            print(result)
-    
-    if len(_futures) > _limit:
-        completed, futures = wait(_futures, return_when=FIRST_COMPLETED)
-    future = _executor.submit(collection.import_bulk, docs, on_duplicate="replace", halt_on_error=False)
-    _futures.add(future)
-    future.add_done_callback(error_handler)
-    return future
+    def __init__(self, batch_size=1000, concurrency=4, max_in_flight=None, retries=3, retry_delay=1):
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._slots = threading.BoundedSemaphore(max_in_flight or concurrency * 2)
+        self._futures = set()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.batches = 0
+            self.docs = 0
+            self.created = 0
+            self.updated = 0
+            self.errors = 0
+            self.retried = 0
+            self.failed_batches = 0
+            self.error_messages = Counter()
+
+    def submit(self, collection, docs):
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._import, collection, docs)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _import(self, collection, docs):
+        for attempt in range(self.retries + 1):
+            try:
+                result = collection.import_bulk(docs, on_duplicate="replace", halt_on_error=False, details=True)
+                break
+            except (ArangoServerError, requests.exceptions.RequestException) as e:
+                transient = getattr(e, 'http_code', None) in self.TRANSIENT_HTTP_CODES or not isinstance(e, ArangoServerError)
+                if not transient or attempt == self.retries:
+                    raise
+                with self._lock:
+                    self.retried += 1
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+        with self._lock:
+            self.batches += 1
+            self.docs += len(docs)
+            self.created += result.get('created', 0)
+            self.updated += result.get('updated', 0)
+            self.errors += result.get('errors', 0)
+            for message in result.get('details', []):
+                # Drop the "at position n: " prefix so alike errors group
+                self.error_messages[message.split(': ', 1)[-1][:200]] += 1
+        return result
+
+    def _done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+            if future.exception():
+                self.failed_batches += 1
+                self.error_messages[str(future.exception())[:200]] += 1
+        self._slots.release()
+
+    def join(self):
+        """
+        Wait for every submitted batch to be imported
+        """
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures)
+
+    def get_stats(self):
+        with self._lock:
+            seconds = time.time() - self.started
+            return {
+                'batches': self.batches,
+                'docs': self.docs,
+                'docs_per_second': self.docs / seconds if seconds else None,
+                'created': self.created,
+                'updated': self.updated,
+                'errors': self.errors,
+                'failed_batches': self.failed_batches,
+                'retried': self.retried,
+                'in_flight': len(self._futures),
+                'top_errors': self.error_messages.most_common(10),
+            }
+
+
+importer = BulkImporter(
+    batch_size=config.get('ARANGO_IMPORT_BATCH_SIZE', 1000),
+    concurrency=config.get('ARANGO_IMPORT_CONCURRENCY', 4),
+)
+
+def import_background(collection, docs):
+    return importer.submit(collection, docs)
@@ -39,13 +39,47 @@ config = Config({
 
     'SECRET': 'CHANGE ME',
     
-    'ARANGO_USER': 'root',
-    'ARANGO_PASSWORD': 'test',
+    'ARANGO_HOSTS': 'http://127.0.0.1:8529',
+    'ARANGO_USER': 'bilara',
+    'ARANGO_PASSWORD': 'bilara',
     'ARANGO_DB_NAME': 'bilara',
+    # Connections kept alive to ArangoDB, shared by all threads
+    'ARANGO_POOL_SIZE': 10,
+    # Documents per bulk import request, and requests made at once
+    'ARANGO_IMPORT_BATCH_SIZE': 1000,
+    'ARANGO_IMPORT_CONCURRENCY': 4,
 
     'PUSHOVER_TOKEN': '',
     'PUSHOVER_ADMIN_KEY': '',
 
+    # Github logins allowed to use admin endpoints such as /api/profile/
+    'ADMIN_LOGINS': [],
+
+    # Profiling of functions decorated with util.profile, also switchable
+    # at runtime through /api/profile/
+    'PROFILING_ENABLED': False,
+    # Fraction of calls to profile when enabled
+    'PROFILING_SAMPLE_RATE': 1.0,
+
+    # Total size on disk of the parsed segment files kept in memory
+    'SEGMENT_CACHE_BYTES': 64 * 1000 * 1000,
+
+    # Seconds for which segment edits are buffered in memory (and in a
+    # journal) before being written to their files
+    'SEGMENT_FLUSH_DELAY': 1,
+
+    # Seconds over which saved files are collected before being committed
+    # to git, with one commit per author
+    'COMMIT_WINDOW': 2,
+
+    # Seconds over which pushes reported by the GitHub webhook are
+    # collected before pulling once for all of them
+    'WEBHOOK_WINDOW': 2,
+
+    # Processes used to parse segment files when building the file index
+    # and the search index, None means one per core
+    'INDEX_WORKERS': None,
+
     'LOCAL_USERNAME': 'Bob',
     'LOCAL_LOGIN': 'Bob',
     'LOCAL_EMAIL': 'bob@example.com'
@@ -1,13 +1,22 @@
+import os
 import sys
-import time
+import mmap
+import fcntl
 import json
 import pickle
+import struct
 import pathlib
 import logging
 from config import config, WORKING_DIR
 from util import humansortkey, bilarasortkey, deep_dict_merge
 from copy import copy, deepcopy
-from threading import Event, Lock
+from collections import defaultdict
+from itertools import chain
+from types import MappingProxyType
+from contextlib import contextmanager
+from threading import Event, Lock, RLock
+
+from git import GitCommandError
 
 from concurrent.futures import ThreadPoolExecutor, Future
 
@@ -17,14 +26,14 @@ from log import problemsLog
 
 import git_fs
 
-from permissions import get_permissions, Permission
+from permissions import get_permissions_bulk, get_rules_version, Permission
 
-from util import json_load
+from util import json_load, count_strings, scan_segment_file, count_segment_file, make_worker_pool
 from projects import get_projects
 
 executor = ThreadPoolExecutor(max_workers=2)
 
-saved_state_file = pathlib.Path("./.saved_state.pickle")
+saved_state_file = pathlib.Path("./.saved_state.index")
 state_build_lock_file = pathlib.Path('./saved_state.lock')
 
 class NoMatchingEntry(Exception):
@@ -76,7 +85,43 @@ def get_long_id(path):
     return pathlib.Path(path).name
 
 
+# Bump whenever the structure of the stored index changes
+STATE_VERSION = 3
+_state_header = struct.Struct("<8sI40s")
+_state_magic = b"BILARAIX"
+
+
+def _interned(obj, memo):
+    """
+    Copy obj with all strings interned, keeping shared objects shared
+
+    pickle stores each distinct string object once, so this means the
+    many repeated paths, uids and muids are stored, and loaded, only once.
+    """
+    if id(obj) in memo:
+        return memo[id(obj)]
+    if isinstance(obj, str):
+        return sys.intern(obj)
+    if isinstance(obj, dict):
+        result = memo[id(obj)] = {}
+        for k, v in obj.items():
+            result[_interned(k, memo)] = _interned(v, memo)
+    elif isinstance(obj, set):
+        result = memo[id(obj)] = {_interned(v, memo) for v in obj}
+    elif isinstance(obj, list):
+        result = memo[id(obj)] = [_interned(v, memo) for v in obj]
+    else:
+        return obj
+    return result
+
+
 def save_state():
+    """
+    Save the file index along with the HEAD sha it reflects
+
+    The file starts with a fixed size header so that a stale or
+    incompatible index can be rejected without unpickling it.
+    """
     print("Saving file index")
     stored = (
         "_tree_index",
@@ -86,30 +131,82 @@ def save_state():
         "_meta_definitions",
         "_special_uid_mapping",
         "_legal_ids",
+        "_segment_order",
     )
     
-    with saved_state_file.open("wb") as f:
-        pickle.dump({k: globals()[k] for k in stored}, f)
+    sha = git_fs.get_head_sha() or ""
+    header = _state_header.pack(_state_magic, STATE_VERSION, sha.encode())
+    memo = {}
+    state = {k: _interned(globals()[k], memo) for k in stored}
+    temp_file = saved_state_file.with_name(f"{saved_state_file.name}.{os.getpid()}.tmp")
+    with temp_file.open("wb") as f:
+        f.write(header)
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_file, saved_state_file)
 
 
 def load_state():
+    """
+    Load the saved file index, returning the HEAD sha it was built at,
+    or None if there is no usable saved index
+    """
     if not saved_state_file.exists():
-        return False
+        return None
     try:
-        with saved_state_file.open("rb") as f:
-            globals().update(pickle.load(f))
+        with saved_state_file.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, version, sha = _state_header.unpack_from(mm)
+            if magic != _state_magic or version != STATE_VERSION:
+                print("Saved file index has an incompatible format")
+                return None
+            with memoryview(mm) as view, view[_state_header.size:] as payload:
+                globals().update(pickle.loads(payload))
         print("Loaded saved file index")
-        return True
+        return sha.rstrip(b"\0").decode()
     except Exception:
+        logging.exception("Could not load saved file index")
         try:
             saved_state_file.unlink()
         except FileNotFoundError:
             pass
     
-    return False
+    return None
+
+
+def _load_saved_index():
+    """
+    Use the saved file index if there is one, patching it with the
+    changes committed since it was built
+    """
+    head = git_fs.get_head_sha()
+    sha = load_state()
+    if not sha or not head:
+        return False
+    if sha != head:
+        try:
+            changes = git_fs.get_changed_files(sha, head)
+        except GitCommandError:
+            print(f"Saved file index is from unknown commit {sha}")
+            return False
+        if any(pathlib.Path(f).name.startswith("_") for f in chain(*changes)):
+            # Metadata changes need a full build
+            return False
+    _bump_index_version()
+    _build_complete.set()
+    stats_calculator.reset()
+    if sha != head:
+        print(f"Updating saved file index from {sha} to {head}")
+        update_file_index(*changes)
+    return True
 
 _build_complete = Event()
 
+# Incremented whenever the file index changes
+_index_version = 0
+
+def _bump_index_version():
+    global _index_version
+    _index_version += 1
+
 def _add_virtual_comment_file(uid, translation_muids, translation_file, uid_index, muid_index, file_index, meta_definitions):
     muids = translation_muids.replace('translation', 'comment')
     comment_stem = f"{uid}_{muids}"
@@ -124,6 +221,41 @@ def _add_virtual_comment_file(uid, translation_muids, translation_file, uid_inde
     for muid in muids.split('-'):
         muid_index[muid].add(comment_stem)
 
+def _add_virtual_project_file(file, root_parent_dir, translation_path, translation_muids, uid_index, muid_index, file_index, subtree, meta_definitions):
+    parent_dir = pathlib.Path(translation_path) / file.parent.relative_to(root_parent_dir)
+    uid, _ = file.stem.split('_') 
+    translation_stem = f'{uid}_{translation_muids}'
+    virtual_file = parent_dir / (translation_stem + '.json')
+    meta = {part: meta_definitions[part]
+               for part in translation_muids.split('-')
+               if part in meta_definitions
+            }
+    obj = {
+        "uid": uid,
+        "path": str(virtual_file),
+        "mtime": None,
+        "_meta": meta
+    }
+    if uid not in uid_index:
+        uid_index[uid] = set()
+    uid_index[uid].add(translation_stem)
+    file_index[translation_stem] = obj
+    for muid in translation_muids.split('-'):
+        if muid not in muid_index:
+            muid_index[muid] = set()
+        muid_index[muid].add(translation_stem)
+    
+    parent_obj = subtree
+    for part in parent_dir.parts:
+        if part not in parent_obj:
+            parent_obj[part] = {}
+        parent_obj = parent_obj[part]
+    if translation_stem not in parent_obj:
+        # Don't clobber real entries
+        parent_obj[translation_stem] = obj
+    # Create virtual comment file entry
+    _add_virtual_comment_file(uid, translation_muids, WORKING_DIR / virtual_file, uid_index, muid_index, file_index, meta_definitions)
+
 def _add_virtual_project_files(uid_index, muid_index, file_index, subtree, meta_definitions):
     for project_id, entry in get_projects().items():
         root_path = entry['root_path']
@@ -133,39 +265,41 @@ def _add_virtual_project_files(uid_index, muid_index, file_index, subtree, meta_
         files = list(root_parent_dir.glob('**/*.json'))
         print(f'Creating project for {project_id}/{translation_muids} with {len(files)} files')
         for file in sorted(files, key=lambda f: bilarasortkey(str(f))):
-            parent_dir = pathlib.Path(translation_path) / file.parent.relative_to(root_parent_dir)
-            uid, _ = file.stem.split('_') 
-            translation_stem = f'{uid}_{translation_muids}'
-            virtual_file = parent_dir / (translation_stem + '.json')
-            meta = {part: meta_definitions[part]
-                       for part in translation_muids.split('-')
-                       if part in meta_definitions
-                    }
-            obj = {
-                "uid": uid,
-                "path": str(virtual_file),
-                "mtime": None,
-                "_meta": meta
-            }
-            if uid not in uid_index:
-                uid_index[uid] = set()
-            uid_index[uid].add(translation_stem)
-            file_index[translation_stem] = obj
-            for muid in translation_muids.split('-'):
-                if muid not in muid_index:
-                    muid_index[muid] = set()
-                muid_index[muid].add(translation_stem)
-            
-            parent_obj = subtree
-            for part in parent_dir.parts:
-                if part not in parent_obj:
-                    parent_obj[part] = {}
-                parent_obj = parent_obj[part]
-            if translation_stem not in parent_obj:
-                # Don't clobber real entries
-                parent_obj[translation_stem] = obj
-            # Create virtual comment file entry
-            _add_virtual_comment_file(uid, translation_muids, WORKING_DIR / virtual_file, uid_index, muid_index, file_index, meta_definitions)
+            _add_virtual_project_file(file, root_parent_dir, translation_path, translation_muids,
+                                      uid_index, muid_index, file_index, subtree, meta_definitions)
+
+@contextmanager
+def build_lock():
+    """
+    Hold an exclusive lock on state_build_lock_file while building the
+    file index
+
+    Yields True if the lock was free. If another process held it, waits
+    for that process to finish and yields False, so the caller can load
+    the index it saved rather than building again. The owner's pid is
+    written to the lock file for diagnostics. flock locks are released
+    by the kernel when their owner exits, so a crashed build can't leave
+    a stale lock behind.
+    """
+    with state_build_lock_file.open("a+") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            lock_was_free = True
+        except BlockingIOError:
+            f.seek(0)
+            owner = f.read().strip() or "unknown"
+            print(f"Waiting for process {owner} to finish building the file index")
+            fcntl.flock(f, fcntl.LOCK_EX)
+            lock_was_free = False
+        f.truncate(0)
+        f.write(str(os.getpid()))
+        f.flush()
+        try:
+            yield lock_was_free
+        finally:
+            f.truncate(0)
+            fcntl.flock(f, fcntl.LOCK_UN)
+
 
 def make_file_index(force=False):
     global _tree_index
@@ -175,30 +309,26 @@ def make_file_index(force=False):
     global _meta_definitions
     global _special_uid_mapping
     global _legal_ids
+    global _segment_order
+
+    with build_lock() as lock_was_free:
+        if not lock_was_free:
+            # Another process has just finished building, use its index
+            if _load_saved_index():
+                return
+        elif not force and config.GIT_COMMIT_ENABLED:
+            # Without commits HEAD says nothing about the working tree contents
+            if _load_saved_index():
+                return
 
-
-    if state_build_lock_file.exists():
-        # We arrived here because another process started the build
-        # let that process do the work
-        for i in range(0, 100):
-            time.sleep(1)
-            if not state_build_lock_file.exists():
-                if load_state():
-                    _build_complete.set()
-                    return
-        # Should not normally reach here, but if so fall through and do the build
-        # regardless after 100 seconds of waiting.
-    try:
-        state_build_lock_file.touch()
         _muid_index = muid_index = {}
         _uid_index = uid_index = {}
         _file_index = file_index = {}
         _legal_ids = set()
 
-        for file in sorted(WORKING_DIR.glob('root/**/*.json')):
-            with file.open() as f:
-                data = json.load(f)
-                _legal_ids.update(data.keys())
+        root_scan, segment_counts = scan_corpus()
+        for segment_ids, count in root_scan.values():
+            _legal_ids.update(segment_ids)
 
         def recurse(folder, meta_definitions=None, depth=0):
             subtree = {}
@@ -235,6 +365,8 @@ def make_file_index(force=False):
                     mtime = file.stat().st_mtime_ns
                     path = str(file.relative_to(WORKING_DIR))
                     obj = subtree[long_id] = {"path": path, "mtime": mtime, "_meta": meta}
+                    if path in segment_counts:
+                        obj["count"] = segment_counts[path]
                     if "_" in long_id:
                         uid, muids = get_uid_and_muids(file)
                     else:
@@ -269,15 +401,15 @@ def make_file_index(force=False):
         _uid_index = uid_index
         _muid_index = muid_index
         _file_index = file_index
-        _special_uid_mapping = make_special_uid_mapping()
+        _special_uid_mapping = make_special_uid_mapping(root_scan)
+        _segment_order = make_segment_order(root_scan)
 
         for v in file_index.values():
             v["_meta"] = invert_meta(v["_meta"])
         print("File Index Built")
         save_state()
+        _bump_index_version()
         _build_complete.set()
-    finally:
-        state_build_lock_file.unlink()
     stats_calculator.reset()
 
 
@@ -285,20 +417,425 @@ _tree_index = None
 _uid_index = None
 
 
-def make_special_uid_mapping():
+def scan_corpus():
+    """
+    Parse the root and translation files once, spread over a process pool
+
+    Returns (root_scan, segment_counts). root_scan is a dict of
+    path: (segment_ids, count) for the root files, which provides the legal
+    ids and the special uid mapping. segment_counts is a dict of path: count
+    of non-empty strings for both root and translation files.
+    """
+    def relative(files):
+        return [str(file.relative_to(WORKING_DIR)) for file in files]
+
+    root_files = sorted(WORKING_DIR.glob("root/**/*.json"))
+    translation_files = sorted(WORKING_DIR.glob("translation/**/*.json"))
+    with make_worker_pool() as pool:
+        root_scan = dict(zip(relative(root_files), pool.map(scan_segment_file, root_files, chunksize=64)))
+        segment_counts = {path: count for path, (_, count) in root_scan.items()}
+        segment_counts.update(zip(relative(translation_files), pool.map(count_segment_file, translation_files, chunksize=64)))
+    return root_scan, segment_counts
+
+
+def make_segment_order(root_scan):
+    """
+    Returns a dict of uid: segment ids of its root files in canonical order
+    """
+    ids_by_uid = {}
+    for path, (segment_ids, _) in root_scan.items():
+        uid = pathlib.Path(path).name.split("_")[0]
+        ids_by_uid.setdefault(uid, []).append(segment_ids)
+
+    segment_order = {}
+    for uid, id_lists in ids_by_uid.items():
+        if len(id_lists) == 1:
+            segment_order[uid] = id_lists[0]
+        else:
+            # Several root editions, which normally share their ids
+            segment_ids = set(chain.from_iterable(id_lists))
+            try:
+                segment_order[uid] = sorted(segment_ids, key=bilarasortkey)
+            except TypeError:
+                segment_order[uid] = list(dict.fromkeys(chain.from_iterable(id_lists)))
+    return segment_order
+
+
+_segment_ranks = cachetools.LRUCache(1000)
+_segment_ranks_lock = Lock()
+
+
+def get_segment_rank(uid):
+    key = (uid, _index_version)
+    with _segment_ranks_lock:
+        rank = _segment_ranks.get(key)
+    if rank is None:
+        rank = {segment_id: i for i, segment_id in enumerate(_segment_order.get(uid, ()))}
+        with _segment_ranks_lock:
+            _segment_ranks[key] = rank
+    return rank
+
+
+def sort_segment_ids(uid, segment_ids):
+    """
+    Returns segment_ids in the canonical order of the root text of uid
+
+    This places each id by its precomputed rank, which avoids running
+    bilarasortkey on every id. If any id isn't in the root text the
+    whole list is sorted with bilarasortkey instead.
+    """
+    rank = get_segment_rank(uid)
+    slots = [None] * len(rank)
+    for segment_id in segment_ids:
+        i = rank.get(segment_id)
+        if i is None:
+            return sorted(segment_ids, key=bilarasortkey)
+        slots[i] = segment_id
+    return [segment_id for segment_id in slots if segment_id is not None]
+
+
+def make_special_uid_mapping(root_scan=None):
+    if root_scan is None:
+        root_scan, _ = scan_corpus()
     uid_mapping = {}
-    for file in WORKING_DIR.glob("root/**/*.json"):
-        if "blurbs" in str(file):
+    for path, (segment_ids, _) in root_scan.items():
+        if "blurbs" in path:
             continue
-        with file.open() as f:
-            data = json.load(f)
-        for k in data:
+        file_uid = pathlib.Path(path).name.split("_")[0]
+        for k in segment_ids:
             uid = k.split(":")[0]
             if uid not in _uid_index and uid not in uid_mapping:
-                uid_mapping[uid] = file.name.split("_")[0]
+                uid_mapping[uid] = file_uid
     return uid_mapping
 
 
+_index_lock = RLock()
+
+
+def _is_indexable(filepath):
+    path = pathlib.Path(filepath)
+    return path.suffix == ".json" and not any(part.startswith(".") for part in path.parts)
+
+
+class IndexPatch:
+    """
+    The changes to the file index made by one update_file_index
+
+    They're made on copies of the index structures, which apply swaps in,
+    so readers never see a partly patched index. The dicts are copied
+    shallowly and each set or subtree is copied the first time it changes.
+    """
+    def __init__(self):
+        self.file_index = dict(_file_index)
+        self.uid_index = dict(_uid_index)
+        self.muid_index = dict(_muid_index)
+        self.tree_index = dict(_tree_index)
+        self.legal_ids = _legal_ids
+        self.special_uid_mapping = _special_uid_mapping
+        self.segment_order = _segment_order
+        # The long ids of every entry added or removed
+        self.long_ids = set()
+        self._copied = set()
+        self._meta_definitions = {}
+        self._projects = None
+
+    def apply(self):
+        global _file_index, _uid_index, _muid_index, _tree_index
+        global _legal_ids, _special_uid_mapping, _segment_order
+        _file_index = self.file_index
+        _uid_index = self.uid_index
+        _muid_index = self.muid_index
+        _tree_index = self.tree_index
+        _legal_ids = self.legal_ids
+        _special_uid_mapping = self.special_uid_mapping
+        _segment_order = self.segment_order
+
+    def get_meta_definitions(self, folder):
+        """
+        Collect the meta definitions in effect for folder, in the same way
+        that make_file_index accumulates them while descending the tree
+        """
+        folder = pathlib.Path(folder)
+        meta_definitions = self._meta_definitions.get(folder)
+        if meta_definitions is None:
+            meta_definitions = {} if folder == WORKING_DIR else dict(self.get_meta_definitions(folder.parent))
+            for metafile in sorted(folder.glob("_*.json"), key=humansortkey):
+                file_data = json_load(metafile)
+                if isinstance(file_data, dict):
+                    meta_definitions.update(file_data)
+            self._meta_definitions[folder] = meta_definitions
+        return meta_definitions
+
+    def get_project_for_path(self, filepath, key):
+        if self._projects is None:
+            self._projects = get_projects()
+        for entry in self._projects.values():
+            if str(filepath).startswith(entry[key].rstrip("/") + "/"):
+                return entry
+        return None
+
+    def _get_set(self, index, key):
+        "Returns index[key] as a set which this patch may change"
+        ids = index.get(key)
+        if ids is None or (id(index), key) not in self._copied:
+            ids = index[key] = set(ids or ())
+            self._copied.add((id(index), key))
+        return ids
+
+    def _get_subtree(self, parts, create=False, real=False):
+        """
+        Returns the subtree for the folder parts which this patch may
+        change, or None if there isn't one and create is False. When the
+        folder is real, it and its parents are given their metadata.
+        """
+        subtree = self.tree_index
+        folder = WORKING_DIR
+        for i, part in enumerate(parts):
+            folder = folder / part
+            child = subtree.get(part)
+            if child is None:
+                if not create:
+                    return None
+                child = {}
+            elif ("tree", parts[:i + 1]) not in self._copied:
+                child = dict(child)
+            subtree[part] = child
+            self._copied.add(("tree", parts[:i + 1]))
+            if real and "_meta" not in child:
+                meta_definitions = self.get_meta_definitions(folder.parent)
+                child["_meta"] = {p: meta_definitions[p] for p in folder.parts if p in meta_definitions}
+            subtree = child
+        return subtree
+
+    def add_tree_entry(self, filepath, obj):
+        path = pathlib.Path(filepath)
+        self._get_subtree(path.parent.parts, create=True, real=True)[path.stem] = obj
+
+    def remove_tree_entry(self, filepath):
+        path = pathlib.Path(filepath)
+        parts = path.parent.parts
+        subtree = self._get_subtree(parts)
+        if subtree is None:
+            return
+        subtree.pop(path.stem, None)
+        # As in a full build, folders on disk stay, while those which are
+        # gone only stay as virtual folders if anything is left in them
+        for i in range(len(parts), 0, -1):
+            if WORKING_DIR.joinpath(*parts[:i]).is_dir():
+                break
+            subtree = self._get_subtree(parts[:i])
+            subtree.pop("_meta", None)
+            if not any(not key.startswith("_") for key in subtree):
+                del self._get_subtree(parts[:i - 1])[parts[i - 1]]
+
+    def add_entry(self, long_id, obj, muids):
+        self.file_index[long_id] = obj
+        self._get_set(self.uid_index, obj["uid"]).add(long_id)
+        for muid in muids:
+            self._get_set(self.muid_index, muid).add(long_id)
+        self.long_ids.add(long_id)
+
+    def discard_entry(self, long_id):
+        obj = self.file_index.pop(long_id, None)
+        if obj is None:
+            return
+        self.long_ids.add(long_id)
+        keys = [(self.uid_index, obj["uid"])]
+        if "_" in long_id:
+            keys.extend((self.muid_index, muid) for muid in long_id.split("_")[1].split("-"))
+        for index, key in keys:
+            if long_id in index.get(key, ()):
+                ids = self._get_set(index, key)
+                ids.discard(long_id)
+                if not ids:
+                    del index[key]
+
+    def discard_virtual_entry(self, long_id):
+        obj = self.file_index.get(long_id)
+        if obj is None or obj["mtime"] is not None:
+            return False
+        self.discard_entry(long_id)
+        return True
+
+    def add_virtual_entries(self, add_entries):
+        """
+        Run add_entries against fresh index dicts and merge the result in,
+        so that newly created virtual entries can have their metadata
+        inverted like make_file_index does for the whole index
+        """
+        uid_index, muid_index, file_index, tree = defaultdict(set), defaultdict(set), {}, {}
+        add_entries(uid_index, muid_index, file_index, tree)
+        for long_id, obj in file_index.items():
+            if long_id in self.file_index:
+                continue
+            obj["_meta"] = invert_meta(obj["_meta"])
+            self.add_entry(long_id, obj, long_id.split("_")[1].split("-"))
+            # Virtual translations also have a place in the tree
+            parts = pathlib.Path(obj["path"]).parent.parts
+            subtree = tree
+            for part in parts:
+                subtree = subtree.get(part, {})
+            if subtree.get(long_id) is obj:
+                self._get_subtree(parts, create=True).setdefault(long_id, obj)
+
+    def add_virtual_translation(self, root_file):
+        project = self.get_project_for_path(root_file.relative_to(WORKING_DIR), "root_path")
+        if not project:
+            return
+        self.add_virtual_entries(lambda uid_index, muid_index, file_index, tree:
+            _add_virtual_project_file(root_file, WORKING_DIR / project["root_path"],
+                                      project["translation_path"], project["translation_muids"],
+                                      uid_index, muid_index, file_index, tree, _meta_definitions))
+
+    def add_virtual_comment(self, translation_file):
+        uid, muids = translation_file.stem.split("_")
+        meta_definitions = self.get_meta_definitions(translation_file.parent)
+        self.add_virtual_entries(lambda uid_index, muid_index, file_index, tree:
+            _add_virtual_comment_file(uid, muids, translation_file,
+                                      uid_index, muid_index, file_index, meta_definitions))
+
+    def remove_file(self, filepath):
+        path = pathlib.Path(filepath)
+        long_id = path.stem
+        obj = self.file_index.get(long_id)
+        if obj is None or obj["path"] != str(path):
+            return
+        self.remove_tree_entry(path)
+        self.discard_entry(long_id)
+        if "_" not in long_id:
+            return
+        uid, muids = long_id.split("_")
+        if path.parts[0] == "translation":
+            self.discard_virtual_entry(f"{uid}_{muids.replace('translation', 'comment')}")
+            project = self.get_project_for_path(path, "translation_path")
+            if project:
+                root_parent_dir = WORKING_DIR / project["root_path"]
+                relative_parent = path.parent.relative_to(project["translation_path"])
+                for root_file in (root_parent_dir / relative_parent).glob(f"{uid}_*.json"):
+                    self.add_virtual_translation(root_file)
+        elif path.parts[0] == "comment":
+            translation_file = WORKING_DIR / str(path).replace("comment", "translation")
+            if translation_file.exists():
+                self.add_virtual_comment(translation_file)
+        elif path.parts[0] == "root":
+            project = self.get_project_for_path(path, "root_path")
+            if project:
+                relative_parent = path.parent.relative_to(project["root_path"])
+                translation_stem = f"{uid}_{project['translation_muids']}"
+                virtual_file = pathlib.Path(project["translation_path"]) / relative_parent / (translation_stem + ".json")
+                if self.discard_virtual_entry(translation_stem):
+                    self.remove_tree_entry(virtual_file)
+                    self.discard_virtual_entry(translation_stem.replace("translation", "comment"))
+
+    def add_file(self, filepath):
+        path = pathlib.Path(filepath)
+        file = WORKING_DIR / path
+        if not file.is_file():
+            return
+        long_id = file.stem
+        meta_definitions = self.get_meta_definitions(file.parent)
+        meta = {}
+        for part in file.parts:
+            if part.endswith(".json"):
+                part = part[:-5]
+            if part in meta_definitions:
+                meta[part] = meta_definitions[part]
+        if "_" in long_id:
+            uid, muids = get_uid_and_muids(file)
+        else:
+            uid = file.stem
+            muids = None
+        obj = {"path": str(path), "mtime": file.stat().st_mtime_ns, "_meta": invert_meta(meta), "uid": uid}
+        if path.parts[0] in {"root", "translation"}:
+            obj["count"] = count_segment_file(file)
+
+        self.discard_entry(long_id)
+        self.add_tree_entry(path, obj)
+        self.add_entry(long_id, obj, muids or [])
+
+        if muids and 'translation' in muids:
+            self.add_virtual_comment(file)
+        elif path.parts[0] == "root":
+            self.add_virtual_translation(file)
+
+    def refresh_root_uids(self, uids):
+        """
+        Recompute the legal segment ids, special uid mapping and segment
+        order contributed by the root files of uids
+        """
+        def owner(segment_id):
+            segment_uid = segment_id.split(":")[0]
+            return self.special_uid_mapping.get(segment_uid, segment_uid)
+
+        self.legal_ids = {segment_id for segment_id in self.legal_ids if owner(segment_id) not in uids}
+        self.special_uid_mapping = {segment_uid: uid for segment_uid, uid in self.special_uid_mapping.items()
+                                    if uid not in uids}
+        self.segment_order = {uid: segment_ids for uid, segment_ids in self.segment_order.items()
+                              if uid not in uids}
+
+        root_scan = {}
+        for uid in uids:
+            for long_id in self.uid_index.get(uid, ()):
+                entry = self.file_index[long_id]
+                if not entry["mtime"] or not entry["path"].startswith("root/"):
+                    continue
+                segment_ids, count = root_scan[entry["path"]] = scan_segment_file(get_file(entry["path"]))
+                self.legal_ids.update(segment_ids)
+                entry["count"] = count
+                if "blurbs" in entry["path"]:
+                    continue
+                for k in segment_ids:
+                    segment_uid = k.split(":")[0]
+                    if segment_uid not in self.uid_index and segment_uid not in self.special_uid_mapping:
+                        self.special_uid_mapping[segment_uid] = uid
+        self.segment_order.update(make_segment_order(root_scan))
+
+
+def update_file_index(added=(), modified=(), removed=()):
+    """
+    Patch the file index for the files changed by a push, rather than
+    rebuilding it from scratch
+
+    Changes to metadata files (names starting with "_") affect everything
+    beneath them, so those still trigger a full make_file_index. The
+    saved index isn't rewritten, since loading it applies the commits
+    made since it was saved.
+    """
+    added = [f for f in added if _is_indexable(f)]
+    modified = [f for f in modified if _is_indexable(f)]
+    removed = [f for f in removed if _is_indexable(f)]
+
+    if any(pathlib.Path(f).name.startswith("_") for f in chain(added, modified, removed)):
+        make_file_index(force=True)
+        return
+
+    if not (added or modified or removed):
+        return
+
+    _build_complete.wait()
+    with _index_lock:
+        patch = IndexPatch()
+        for filepath in removed:
+            patch.remove_file(filepath)
+        for filepath in chain(added, modified):
+            patch.add_file(filepath)
+
+        root_uids = {get_uid_and_muids(f)[0]
+                     for f in chain(added, modified, removed)
+                     if pathlib.Path(f).parts[0] == "root" and "_" in pathlib.Path(f).stem}
+        if root_uids:
+            patch.refresh_root_uids(root_uids)
+
+        patch.apply()
+        _bump_index_version()
+
+    affected_uids = {long_id.split("_")[0] for long_id in patch.long_ids}
+    for uid in affected_uids:
+        for long_id in _uid_index.get(uid, ()):
+            stats_calculator.invalidate(_file_index[long_id]["path"])
+    print(f"File Index Updated: {len(patch.long_ids)} entries")
+
+
 class StatsCalculator:
     def __init__(self):
         self.reset()
@@ -347,20 +884,36 @@ class StatsCalculator:
         return {"_translated": translated_count, "_root": total_count}
 
     def count_strings(self, entry):
-        json_file = get_file(entry["path"])
-        data = json_load(json_file)
-        count = 0
-        for k, v in data.items():
-            if k == "_meta":
-                continue
-            if v:
-                count += 1
-        return count
+        if entry.get("count") is None:
+            entry["count"] = count_strings(json_load(get_file(entry["path"])))
+        return entry["count"]
 
 
 stats_calculator = StatsCalculator()
 
 
+def update_file_entry(filepath, count):
+    """
+    Bring the index entry for a file which has just been saved up to date,
+    given its new count of non-empty strings, without re-reading the file
+    """
+    entry = _file_index.get(pathlib.Path(filepath).stem)
+    if entry is None or entry["path"] != filepath:
+        return
+    entry["mtime"] = get_file(filepath).stat().st_mtime_ns
+    entry["count"] = count
+    stats_calculator.invalidate(filepath)
+    if filepath.startswith("root/"):
+        # The root's count is the total for each translation of it
+        entries = [_file_index[long_id] for long_id in _uid_index.get(entry["uid"], ())
+                   if _file_index[long_id]["path"].startswith("translation/")]
+        for translation in entries:
+            stats_calculator.invalidate(translation["path"])
+    else:
+        entries = [entry]
+    update_nav_trees(entries)
+
+
 def get_matching_ids(uid, muids=None, permit_none=True):
     if permit_none and muids is not None:
         muids = [muid for muid in muids if muid is not None]
@@ -385,17 +938,71 @@ def get_matching_id(uid, muids=None, permit_none=True):
         raise ValueError(f"Multiple matches for {uid}, {muids}")
 
 
-def load_json(entry):
-    _meta = entry.get("_meta", {})
-    _meta["path"] = entry.get("path")
+class SegmentCache:
+    """
+    LRU cache of parsed segment files, bounded by the total size of the
+    files on disk
 
-    json_file = get_file(entry["path"])
+    Entries are validated against the file's mtime and size, and should
+    also be invalidated explicitly when a file is written. The segments
+    are returned as read-only views shared between requests.
 
-    if json_file.exists():
-        segments = json_load(json_file)
-    else:
-        segments = {}
-    return {**deepcopy(_meta), "segments": segments}
+    Segments which have been edited but not yet written to disk are set
+    as pending, and take precedence over the file until cleared.
+    """
+    def __init__(self, max_bytes):
+        self._cache = cachetools.LRUCache(max_bytes, getsizeof=lambda item: max(1, item[1]))
+        self._pending = {}
+        self._generation = 0
+        self._lock = Lock()
+
+    def get(self, file):
+        pending = self._pending.get(str(file))
+        if pending:
+            return pending[1]
+        try:
+            stat = file.stat()
+        except FileNotFoundError:
+            return MappingProxyType({})
+        key = str(file)
+        with self._lock:
+            item = self._cache.get(key)
+        if item and item[0] == stat.st_mtime_ns and item[1] == stat.st_size:
+            return item[2]
+        segments = MappingProxyType(json_load(file))
+        with self._lock:
+            try:
+                self._cache[key] = (stat.st_mtime_ns, stat.st_size, segments)
+            except ValueError:
+                # Larger than the whole cache
+                pass
+        return segments
+
+    def invalidate(self, file):
+        with self._lock:
+            self._cache.pop(str(file), None)
+
+    def set_pending(self, file, segments):
+        with self._lock:
+            self._generation += 1
+            self._pending[str(file)] = (self._generation, MappingProxyType(segments))
+
+    def clear_pending(self, file):
+        with self._lock:
+            self._pending.pop(str(file), None)
+
+    def get_pending_generation(self, file):
+        pending = self._pending.get(str(file))
+        return pending[0] if pending else None
+
+
+segment_cache = SegmentCache(config.get("SEGMENT_CACHE_BYTES", 64 * 1000 * 1000))
+
+
+def load_json(entry):
+    _meta = entry.get("_meta", {})
+    segments = segment_cache.get(get_file(entry["path"]))
+    return {**_meta, "path": entry.get("path"), "segments": segments}
 
 
 def load_entry(long_id):
@@ -429,24 +1036,78 @@ def get_matching_entry(uid, muids, permit_none=True):
         raise NoMatchingEntry("No matches for {uid}, {muids}")
 
 
-def update_result(result, long_id, entry, role=None, user=None):
-    segments = entry.pop("segments")
+def update_result(result, columns, long_id, entry, role=None):
+    """
+    Adds a field to result, keeping its segments aside as a column
+    """
     uid, muids = get_uid_and_muids(long_id)
     field = "-".join(muids)
 
-    entry = deepcopy(entry)
-    entry["permission"] = get_permissions(entry["path"], github_id=user['login']).name
+    entry = dict(entry)
+    columns[field] = entry.pop("segments")
+    entry["permission"] = None  # Resolved for all fields at once
     entry["editable"] = True if role == "target" else False
+    entry["role"] = role or muids[0]
     result["fields"][field] = entry
-    result["fields"][field]["role"] = role or muids[0]
-    for segment_id, segment_value in segments.items():
-        if segment_id not in result["segments"]:
-            result["segments"][segment_id] = {}
-        result["segments"][segment_id][field] = segment_value
 
     return result
 
 
+def get_data_version(primary_long_id):
+    """
+    Returns a value which changes whenever get_data for primary_long_id
+    may return something different, without loading any segments
+    """
+    uid, _ = get_uid_and_muids(primary_long_id)
+    files = []
+    for long_id in sorted(_uid_index.get(uid, ())):
+        path = _file_index[long_id].get("path")
+        if not path:
+            continue
+        file = get_file(path)
+        pending = segment_cache.get_pending_generation(file)
+        try:
+            stat = file.stat()
+            files.append((path, stat.st_mtime_ns, stat.st_size, pending))
+        except FileNotFoundError:
+            files.append((path, None, None, pending))
+    return (_index_version, get_rules_version(), tuple(files))
+
+
+def merge_columns(segment_ids, columns):
+    """
+    Returns the segments of a result, merging each column row by row
+    """
+    columns = list(columns.items())
+    return {
+        segment_id: {field: column[segment_id] for field, column in columns if segment_id in column}
+        for segment_id in segment_ids
+    }
+
+
+def iter_data_json(result, segment_ids, columns, chunk_size=500):
+    """
+    Yields the JSON encoding of the result of get_data in chunks,
+    without building the merged segments
+    """
+    encode = json.JSONEncoder(ensure_ascii=False).encode
+    columns = list(columns.items())
+    fields = [(encode(field), column) for field, column in columns]
+    chunk = ['{"segments": {']
+    for i, segment_id in enumerate(segment_ids):
+        values = ", ".join(f"{field}: {encode(column[segment_id])}" for field, column in fields if segment_id in column)
+        chunk.append(f'{", " if i else ""}{encode(segment_id)}: {{{values}}}')
+        if len(chunk) >= chunk_size:
+            yield "".join(chunk)
+            chunk = []
+    chunk.append("}")
+    for key, value in result.items():
+        if key != "segments":
+            chunk.append(f", {encode(key)}: {encode(value)}")
+    chunk.append("}")
+    yield "".join(chunk)
+
+
 def get_data(primary_long_id, user=None, root=None, tertiary=None):
     """
 
@@ -512,15 +1173,27 @@ def get_data(primary_long_id, user=None, root=None, tertiary=None):
 
 
 
+    """
+    result, segment_ids, columns = get_data_columns(primary_long_id, user=user, root=root, tertiary=tertiary)
+    result["segments"] = merge_columns(segment_ids, columns)
+    return result
+
+
+def get_data_columns(primary_long_id, user=None, root=None, tertiary=None):
+    """
+    Returns (result, segment_ids, columns) where columns is a dict of
+    field: segments and segment_ids is their union in canonical order.
+    merge_columns or iter_data_json turn these into the result of get_data.
     """
 
     if not root:
         root = "root"
 
     result = {"segments": {}, "fields": {}}
+    columns = {}
     primary_entry = load_entry(primary_long_id)
 
-    update_result(result, primary_long_id, primary_entry, role="target", user=user)
+    update_result(result, columns, primary_long_id, primary_entry, role="target")
     result["targetField"] = primary_long_id.split("_")[1]
 
     uid, _ = get_uid_and_muids(primary_long_id)
@@ -531,7 +1204,7 @@ def get_data(primary_long_id, user=None, root=None, tertiary=None):
             root_long_id = get_matching_id(uid, [muid, root_lang, root_edition])
             root_entry = load_entry(root_long_id)
             role = "source" if muid == "root" else muid
-            update_result(result, root_long_id, root_entry, role=role, user=user)
+            update_result(result, columns, root_long_id, root_entry, role=role)
             if role == "source":
                 result["sourceField"] = root_long_id.split("_")[1]
         except NoMatchingEntry:
@@ -548,16 +1221,15 @@ def get_data(primary_long_id, user=None, root=None, tertiary=None):
             if matches:
                 for long_id in matches:
                     entry = load_entry(long_id)
-                    update_result(result, long_id, entry, role="tertiary", user=user)
+                    update_result(result, columns, long_id, entry, role="tertiary")
 
+    all_segment_ids = dict.fromkeys(chain.from_iterable(columns.values()))
     try:
-        sorted_results = sorted(
-            result["segments"].items(), key=lambda t: bilarasortkey(t[0])
-        )
+        segment_ids = sort_segment_ids(uid, all_segment_ids)
     except TypeError:
         print("Sort failure ", file=sys.stderr)
-        for k in result["segments"].keys():
-            for k2 in result["segments"].keys():
+        for k in all_segment_ids:
+            for k2 in all_segment_ids:
                 try:
                     sorted([k, k2], key=lambda t: bilarasortkey(t))
                 except TypeError:
@@ -565,11 +1237,14 @@ def get_data(primary_long_id, user=None, root=None, tertiary=None):
                     print(f"{k} > {k2}", file=sys.stderr)
 
         raise
-    result["segments"] = dict(sorted_results)
+
+    permissions = get_permissions_bulk({field["path"] for field in result["fields"].values()}, user['login'])
+    for field in result["fields"].values():
+        field["permission"] = permissions[field["path"]].name
 
     result["potential"] = [name.split("_")[1] for name in _uid_index[uid]]
 
-    return result
+    return result, segment_ids, columns
 
 
 def sum_counts(subtree):
@@ -590,30 +1265,119 @@ def sum_counts(subtree):
 
 
 
-cache = cachetools.TTLCache(5*1000*1000, ttl=60)
+# Nav trees and permission masks per (path, login), each stored with the
+# versions of the data it was made from so it is only rebuilt on change.
+# All three caches are guarded by cache_lock
+cache = cachetools.LRUCache(1000)
 cache_lock = Lock()
+_permission_masks = cachetools.LRUCache(1000)
+# Incremented for a (path, login) whenever its cached nav tree is patched
+_nav_generations = cachetools.LRUCache(1000)
 
 from util import profile
 
 
+def get_nav_version():
+    return (
+        _index_version,
+        get_rules_version(),
+        git_fs.get_publication_version(),
+    )
+
+
+def get_nav_generation(path, user):
+    with cache_lock:
+        return _nav_generations.get((tuple(path), user["login"]), 0)
+
+
+def update_nav_trees(entries):
+    """
+    Bring the completion of entries up to date in the cached nav trees,
+    along with the sums of their parents, rather than rebuilding them
+    """
+    with cache_lock:
+        for key, (version, future) in list(cache.items()):
+            if not future.done():
+                # It may have read the old completion
+                del cache[key]
+            elif future.exception() or not _patch_nav_tree(key[0], future.result(), entries):
+                continue
+            _nav_generations[key] = _nav_generations.get(key, 0) + 1
+
+
+def _patch_nav_tree(path, tree, entries):
+    patched = False
+    for entry in entries:
+        parts = pathlib.Path(entry["path"]).with_suffix("").parts
+        if parts[:len(path)] != path:
+            continue
+        nodes = [tree]
+        for part in parts[len(path):]:
+            if part not in nodes[-1]:
+                break
+            nodes.append(nodes[-1][part])
+        else:
+            document = nodes.pop()
+            if "_root" not in document:
+                # Only shown to those who may edit it
+                continue
+            completion = stats_calculator.get_completion(entry)
+            translated = completion["_translated"] - document["_translated"]
+            root = completion["_root"] - document["_root"]
+            document.update(completion)
+            for node in nodes:
+                node["_translated_count"] += translated
+                node["_root_count"] += root
+            patched = True
+    return patched
+
+
 def get_condensed_tree(path, user):
-    key = str(path) + str(sorted(user.items()))
+    key = (tuple(path), user["login"])
+    version = get_nav_version()
     with cache_lock:
-        future = cache.get(key)
-        if not future:
-            future = cache[key] = executor.submit(get_condensed_tree_bg, path, user)
-    return future.result()
+        cached = cache.get(key)
+        if not cached or cached[0] != version or (cached[1].done() and cached[1].exception()):
+            cached = cache[key] = (version, executor.submit(get_condensed_tree_bg, path, user))
+    return cached[1].result()
 
 @profile(sort_args=['cumulative'])
 def get_condensed_tree_bg(path, user):
     print(f"Using user {user}")
     _build_complete.wait()
+    return _get_condensed_tree(path, user)
+
+
+def _get_condensed_tree(path, user):
     tree = _tree_index
     for part in path:
         tree = tree[part]
     
     publication_state = git_fs.get_publication_state()
 
+    def collect_paths(subtree, parents, paths):
+        for key, value in subtree.items():
+            path = value.get("path", "")
+            if path.endswith(".json"):
+                paths.append(path)
+            elif key.startswith("_meta"):
+                continue
+            else:
+                paths.append('/'.join(parents + [key]))
+                collect_paths(value, parents + [key], paths)
+        return paths
+
+    key = (tuple(path), user["login"])
+    mask_version = (_index_version, get_rules_version())
+    with cache_lock:
+        cached = _permission_masks.get(key)
+    if cached and cached[0] == mask_version:
+        permissions = cached[1]
+    else:
+        permissions = get_permissions_bulk(collect_paths(tree, path, []), user["login"])
+        with cache_lock:
+            _permission_masks[key] = (mask_version, permissions)
+
     def recurse(subtree, parents=None, may_publish=False):
         result = {}
         highest_permission = Permission.NONE
@@ -623,7 +1387,7 @@ def get_condensed_tree_bg(path, user):
             if path.endswith(".json"):
                 result[key] = {}
                 result[key]["_type"] = "document"
-                permission = get_permissions(path, user["login"])
+                permission = permissions[path]
                 if not highest_permission:
                     highest_permission = permission
                 else:
@@ -636,7 +1400,7 @@ def get_condensed_tree_bg(path, user):
                 continue
             else:
                 path = '/'.join(parents + [key])
-                dir_permission = get_permissions(path, user["login"])
+                dir_permission = permissions[path]
                 may_publish = dir_permission == Permission.EDIT
                 permission, result[key] = recurse(value, parents=parents + [key], may_publish=may_publish)
                 result[key]["_type"] = "node"
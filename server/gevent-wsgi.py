@@ -1,6 +1,7 @@
 from gevent import monkey
 monkey.patch_all()
-from app import app
 
 if __name__ == "__main__":
+    # Process pool workers import __main__, they mustn't start the app
+    from app import app
     app.run()
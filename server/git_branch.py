@@ -21,6 +21,8 @@ class GitBranch:
     path = None
     name = None
     lock = None
+    _file_map = None
+    _file_map_sha = None
 
     def get_checkout_dir(self):
         return CHECKOUTS_DIR / self.name
@@ -50,16 +52,61 @@ class GitBranch:
             self.repo = self.get_or_create_repo()
 
     def get_file_map(self):
+        """
+        Returns a dict of filepath: blob sha for the head of the branch,
+        which must not be modified
+
+        The map is kept along with the commit it was made for, and when
+        the branch moves it is brought up to date from a diff of the two
+        trees rather than listed again.
+        """
+        with self.lock:
+            sha = self.repo.commit(self.name).hexsha
+            if self._file_map_sha != sha:
+                if self._file_map_sha is None:
+                    self._file_map = self.list_files(sha)
+                else:
+                    self.update_file_map(self._file_map, self._file_map_sha, sha)
+                self._file_map_sha = sha
+            return self._file_map
+
+    def list_files(self, sha):
         files = {}
 
-        r = self.repo.git.ls_tree('-r', self.name)
+        r = self.repo.git.ls_tree('-r', sha)
         
         for line in r.split('\n'):
             if line:
-                p, t, sha, filepath  = line.split()
+                info, filepath = line.split('\t', 1)
+                p, t, sha = info.split()
                 files[filepath] = sha
         return files
 
+    def update_file_map(self, files, old_sha, new_sha):
+        try:
+            r = self.repo.git.diff_tree('-r', '--no-renames', old_sha, new_sha)
+        except GitCommandError:
+            # The old commit is gone, say after a forced push
+            files.clear()
+            files.update(self.list_files(new_sha))
+            return
+
+        for line in r.split('\n'):
+            if line:
+                info, filepath = line.split('\t', 1)
+                old_mode, new_mode, old_blob, new_blob, status = info.split()
+                if status == 'D':
+                    files.pop(filepath, None)
+                else:
+                    files[filepath] = new_blob
+
+    def get_changed_files(self, old_sha, new_sha):
+        """
+        Returns the set of files which differ between two commits
+        """
+        r = self.repo.git.diff_tree('-r', '--no-renames', '--name-only', old_sha, new_sha)
+        return {filepath for filepath in r.split('\n') if filepath}
+
     def pull(self):
         print(f'Pulling {self.name}')
         self.repo.git.pull()
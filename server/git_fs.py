@@ -1,15 +1,18 @@
+import os
+import json
 import logging
 import pathlib
 from collections import defaultdict
 from git import Repo, GitCommandError
 from config import (GIT_REMOTE_REPO, REPO_DIR, CHECKOUTS_DIR,
-                    PUBLISHED_BRANCH_NAME, UNPUBLISHED_BRANCH_NAME, GIT_SYNC_ENABLED)
+                    PUBLISHED_BRANCH_NAME, UNPUBLISHED_BRANCH_NAME, GIT_SYNC_ENABLED, config)
 
 
 import threading
 import time
 
 import notify
+import util
 
 import atexit
 
@@ -19,7 +22,14 @@ import git_pr
 
 
 _lock = threading.RLock()
+# Held while git rewrites files in the working tree, and while bilara
+# writes segment files, so that neither sees the other's partial changes
+worktree_lock = threading.RLock()
 PUSH_DELAY = 15
+# Seconds over which saved files are collected into one commit per author
+COMMIT_WINDOW = config.get('COMMIT_WINDOW', 2)
+# Seconds over which webhook pushes are collected into one pull
+WEBHOOK_WINDOW = config.get('WEBHOOK_WINDOW', 2)
 
 published = GitBranch(PUBLISHED_BRANCH_NAME)
 unpublished = GitBranch(UNPUBLISHED_BRANCH_NAME)
@@ -31,25 +41,38 @@ def create_empty_commit(user, branch_name):
     _pending_commits[branch_name] = time.time()
 
 _pending_commit = None
+_pending_commit_files = set()
+
+def make_commit_message(login, files):
+    if len(files) == 1:
+        return f'Translations by {login} to {next(iter(files))}'
+    return f'Translations by {login} to {len(files)} files\n\n' + '\n'.join(sorted(files))
 
 def update_file(file, user):
-    global _pending_commit
+    commit_files([file], user)
+
+def commit_files(files, user):
+    """
+    Commit files with one git add and one commit, amending the commit
+    waiting to be pushed if it is also by user
+    """
+    global _pending_commit, _pending_commit_files
     branch = unpublished.branch
-    file = str(file).lstrip('/')
+    files = {str(file).lstrip('/') for file in files}
     with _lock:
-        commit_message = f'Translations by {user["login"]} to {file}'
-
-        if _pending_commit and branch.commit.message == commit_message:
+        if _pending_commit and branch.commit.message.strip() == make_commit_message(user["login"], _pending_commit_files):
             # We can add onto this commit
-            git.add(file)
-            git.commit(amend=True, no_edit=True)
+            _pending_commit_files |= files
+            git.add(list(files))
+            git.commit(amend=True, m=make_commit_message(user["login"], _pending_commit_files))
         else:
             finalize_commit()
 
-            git.add(file)
+            git.add(list(files))
             try:
-                git.commit(m=commit_message, author=f'{user.get("name") or user["login"]} <{user["email"]}>')
+                git.commit(m=make_commit_message(user["login"], files), author=f'{user.get("name") or user["login"]} <{user["email"]}>')
                 _pending_commit = branch.commit
+                _pending_commit_files = files
             except GitCommandError as e:
                 if e.status == 1 and ('nothing to commit' in e.stdout or 'nothing added to commit' in e.stdout):
                     # This is unusual but fine
@@ -57,6 +80,123 @@ def update_file(file, user):
                 else:
                     raise
 
+class BatchQueue:
+    """
+    Items handled in batches by a background thread
+
+    Once an item is queued, others are collected for window seconds and
+    then handed to process together. Subclasses add items to _queued, a
+    list or dict, calling _queueing first, and may set _retry_at to hold
+    the next batch back until then.
+    """
+    def __init__(self, window, queued):
+        self.window = window
+        self._queued = queued
+        self._queued_since = None
+        self._retry_at = 0
+        self._processing = False
+        self._condition = threading.Condition()
+        self.batches = 0
+        self.last_batch_seconds = None
+
+    def _queueing(self):
+        "Called with the condition held before adding to _queued"
+        if not self._queued:
+            self._queued_since = time.time()
+        self._condition.notify_all()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._queued:
+                    self._condition.wait()
+                delay = max(self._queued_since + self.window, self._retry_at) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            with self._condition:
+                batch, batch_since = self._queued.copy(), self._queued_since
+                self._queued.clear()
+                self._processing = True
+            start = time.time()
+            try:
+                self.process(batch, batch_since)
+            except Exception:
+                logging.exception(f'{type(self).__name__} failed to process a batch')
+            finally:
+                with self._condition:
+                    self._processing = False
+                    self.batches += 1
+                    self.last_batch_seconds = time.time() - start
+                    self._condition.notify_all()
+
+    def process(self, batch, batch_since):
+        raise NotImplementedError
+
+    def join(self):
+        """
+        Wait until everything queued has been handled
+        """
+        with self._condition:
+            while self._queued or self._processing:
+                self._condition.wait()
+
+    def get_stats(self):
+        with self._condition:
+            return {
+                'oldest_queued_seconds': time.time() - self._queued_since if self._queued else None,
+                'processing': self._processing,
+                'batches': self.batches,
+                'last_batch_seconds': self.last_batch_seconds,
+            }
+
+    def start(self):
+        consumer = threading.Thread(target=self.run)
+        consumer.daemon = True
+        consumer.start()
+        return consumer
+
+class CommitQueue(BatchQueue):
+    """
+    Files waiting to be committed, grouped by author
+
+    A single thread commits them, so saving a file never waits on git.
+    Queued files are committed with one git add and one commit per author.
+    """
+    def __init__(self, window):
+        # login: (user, set of files)
+        super().__init__(window, {})
+        self.files_committed = 0
+
+    def put(self, file, user):
+        with self._condition:
+            self._queueing()
+            files = self._queued[user["login"]][1] if user["login"] in self._queued else set()
+            files.add(file)
+            self._queued[user["login"]] = (user, files)
+
+    def process(self, batch, batch_since):
+        for user, files in batch.values():
+            try:
+                commit_files(files, user)
+            except Exception:
+                logging.exception("Git Commit Failed")
+        with self._condition:
+            self.files_committed += sum(len(files) for _, files in batch.values())
+
+    def get_stats(self):
+        with self._condition:
+            return {
+                **super().get_stats(),
+                'queued_files': sum(len(files) for _, files in self._queued.values()),
+                'queued_authors': len(self._queued),
+                'files_committed': self.files_committed,
+                'pending_push': _pending_commit is not None,
+            }
+
+commit_queue = CommitQueue(COMMIT_WINDOW)
+_committer = commit_queue.start()
+
 def update_files(user, files):
     global _pending_commit
     with _lock:
@@ -101,38 +241,202 @@ def publish_localization(files, files_deleted):
         return {'error': str(e) }
 
 def githook(webhook_payload):
-    ref = webhook_payload['ref'].split('/')[-1]
-    if ref != unpublished.name:
-        if ref == published.name:
-            published.pull()
-        return
-
-    added = []
-    modified = []
-    removed = []
-
-    for commit in webhook_payload['commits']:
-        if commit['id'] == unpublished.branch.commit.hexsha:
-            return
-        added.extend(commit['added'])
-        modified.extend(commit['modified'])
-        removed.extend(commit['removed'])
-
-    print(f'{len(added)} added, {len(modified)} modified, {len(removed)} removed')
-    with _lock:
+    webhook_queue.put(webhook_payload)
+
+def update_from_remote(old_sha=None):
+    """
+    Pull the unpublished branch and bring the file index and search up
+    to date with the files changed since old_sha, by default those the
+    pull changed
+    """
+    from segment_updates import segment_writer
+    segment_writer.flush()
+    # The pull would refuse to overwrite saved files not yet committed
+    commit_queue.join()
+    if old_sha is None:
+        old_sha = get_head_sha()
+    with _lock, worktree_lock:
         if _pending_commit:
             finalize_commit()
         git.pull('-Xtheirs')
+    new_sha = get_head_sha()
+    if old_sha == new_sha:
+        return
 
-    if added or removed  or '_project.json' in modified or '_publication.json' in modified:
+    added, modified, removed = get_changed_files(old_sha, new_sha)
+    print(f'{len(added)} added, {len(modified)} modified, {len(removed)} removed')
+
+    if '_project.json' in modified or '_publication.json' in modified:
         import app
         app.init()
+    elif added or modified or removed:
+        import fs
+        fs.update_file_index(added, modified, removed)
 
     from search import search
-    search.update_partial(added, modified)
+    search.update_changes(old_sha, added, modified, removed)
+
+class WebhookQueue(BatchQueue):
+    """
+    Pushes reported by the GitHub webhook, handled by a background thread
+
+    A push is appended to a journal before the webhook returns. Queued
+    pushes are handled together: one pull per branch, and one index and
+    search update for all the files changed by the pull. Each process
+    keeps its own journal, and recover handles the pushes left in it and
+    in the journals of processes which have exited.
+
+    A batch which fails is retried up to max_retries times, waiting
+    retry_delay seconds and doubling that each time. The commit pulled
+    from, since, is journalled before pulling and kept until the index
+    and search have been updated, so that a retry, or the next batch
+    after giving up, updates them for every file changed since.
+    """
+    def __init__(self, journal_file, window, max_retries=5, retry_delay=30):
+        super().__init__(window, [])
+        self.journal = util.ProcessJournal(journal_file)
+        self.since = None
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.failures = 0
+        self.received = 0
+        self.last_error = None
+
+    def put(self, webhook_payload):
+        entry = {'ref': webhook_payload['ref'].split('/')[-1], 'after': webhook_payload.get('after')}
+        with self._condition:
+            self._write_journal([entry])
+            self._queueing()
+            self._queued.append(entry)
+            self.received += 1
+
+    def _write_journal(self, entries):
+        with self.journal.path.open('a') as f:
+            f.writelines(json.dumps(entry) + '\n' for entry in entries)
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def _read_journal(journal_file):
+        if not journal_file.exists():
+            return []
+        with journal_file.open('r') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def recover(self):
+        with self._condition:
+            entries = self._read_journal(self.journal.path)
+            for journal_file in self.journal.orphans():
+                orphaned = self._read_journal(journal_file)
+                # Journalled here before the orphaned journal is removed
+                self._write_journal(orphaned)
+                entries += orphaned
+            since = {entry['since'] for entry in entries if 'since' in entry}
+            if len(since) > 1:
+                since = {git.merge_base('--octopus', *since)}
+            if since:
+                self.since = since.pop()
+            pushes = [entry for entry in entries if 'since' not in entry]
+            if pushes:
+                print(f'Resuming {len(pushes)} queued webhook pushes')
+                self._queueing()
+                self._queued.extend(pushes)
+
+    def process(self, batch, batch_since):
+        try:
+            self.pull(batch)
+            self.last_error = None
+            self.failures = 0
+        except Exception as e:
+            logging.exception('Webhook processing failed')
+            self.last_error = str(e)
+            self.failures += 1
+        with self._condition:
+            if self.failures > self.max_retries:
+                logging.error(f'Giving up on {len(batch)} webhook pushes after {self.failures} attempts')
+                self.failures = 0
+            elif self.failures:
+                # Retry the batch ahead of anything which arrived meanwhile
+                self._queued[:0] = batch
+                self._queued_since = batch_since
+                self._retry_at = time.time() + self.retry_delay * 2 ** (self.failures - 1)
+            # Only what is left to be done stays in the journal
+            journal_file = self.journal.path
+            temp_file = journal_file.with_name(f'{journal_file.name}.tmp')
+            with temp_file.open('w') as f:
+                if self.since:
+                    f.write(json.dumps({'since': self.since}) + '\n')
+                f.writelines(json.dumps(entry) + '\n' for entry in self._queued)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_file, journal_file)
+
+    def pull(self, batch):
+        refs = {entry['ref'] for entry in batch}
+        if published.name in refs:
+            published.pull()
+        if unpublished.name in refs:
+            with self._condition:
+                if self.since is None:
+                    heads = {entry['after'] for entry in batch if entry['ref'] == unpublished.name}
+                    if heads == {get_head_sha()}:
+                        # Only our own pushes
+                        return
+                    self.since = get_head_sha()
+                    self._write_journal([{'since': self.since}])
+            update_from_remote(self.since)
+            self.since = None
+
+    def get_stats(self):
+        with self._condition:
+            return {
+                **super().get_stats(),
+                'queued': len(self._queued),
+                'queued_branches': sorted({entry['ref'] for entry in self._queued}),
+                'received': self.received,
+                'last_error': self.last_error,
+                'failures': self.failures,
+                'since': self.since,
+            }
+
+webhook_queue = WebhookQueue(pathlib.Path('./.webhook_queue'), WEBHOOK_WINDOW)
+_webhook_consumer = webhook_queue.start()
+
+
+def get_head_sha():
+    try:
+        return unpublished.repo.head.commit.hexsha
+    except ValueError:
+        # Empty repository
+        return None
+
+def read_file_at(sha, filepath):
+    """
+    Returns the contents of a file at a commit, or None if it didn't exist
+    """
+    try:
+        blob = unpublished.repo.commit(sha).tree / filepath
+    except KeyError:
+        return None
+    return blob.data_stream.read().decode('utf8')
+
+def get_changed_files(old_sha, new_sha):
+    """
+    Returns the files added, modified and removed between two commits
+    """
+    added = []
+    modified = []
+    removed = []
+    changes = {'A': added, 'M': modified, 'T': modified, 'D': removed}
+    r = git.diff('--name-status', '--no-renames', old_sha, new_sha)
+    for line in r.split('\n'):
+        if line:
+            status, filepath = line.split('\t', 1)
+            changes[status[0]].append(filepath)
+    return added, modified, removed
 
 
-def get_publication_line_counts():
+def make_publication_line_counts():
     file_stats = base_repo.git.diff('unpublished..published', '--numstat')
 
     result = defaultdict(int)
@@ -148,10 +452,42 @@ def get_publication_line_counts():
 
     return dict(result)
 
+# Without GIT_SYNC_ENABLED, the branches are pulled when the publication
+# state is asked for, at most once per this many seconds
+PUBLICATION_PULL_INTERVAL = 60
+_publication_pulled_at = None
+
+def pull_if_due():
+    global _publication_pulled_at
+    if GIT_SYNC_ENABLED:
+        return
+    now = time.monotonic()
+    if _publication_pulled_at is not None and now - _publication_pulled_at < PUBLICATION_PULL_INTERVAL:
+        return
+    _publication_pulled_at = now
+    published.pull()
+    unpublished.pull()
+
+def get_publication_version():
+    """
+    Returns a value which changes whenever the publication state may
+    have changed
+    """
+    pull_if_due()
+    try:
+        pr_log_mtime = git_pr.pr_log.path.stat().st_mtime_ns
+    except FileNotFoundError:
+        pr_log_mtime = None
+    return (published.repo.head.commit.hexsha, unpublished.repo.head.commit.hexsha, pr_log_mtime)
+
 def get_publication_state():
-    if not GIT_SYNC_ENABLED:
-        published.pull()
-        unpublished.pull()
+    pull_if_due()
+    return publication_state.get()
+
+def get_publication_line_counts():
+    return publication_state.get_line_counts()
+
+def make_publication_state():
     published_files = published.get_file_map()
     unpublished_files = unpublished.get_file_map()
 
@@ -161,21 +497,10 @@ def get_publication_state():
     from permissions import make_may_publish_regex
     may_publish_regex = make_may_publish_regex()
     result = defaultdict(lambda: {'PUBLISHED':0, 'UNPUBLISHED': 0, 'MODIFIED': 0})
-    for filepath, sha in unpublished_files.items():
-        pathkey = filepath[:-5] if filepath.endswith('.json') else filepath
-        if not filepath.startswith('translation/'):
-            continue
-        elif not may_publish_regex.match(filepath):
+    for filepath in unpublished_files:
+        state = get_file_publication_state(filepath, published_files, unpublished_files, pr_in_progress, may_publish_regex)
+        if state is None:
             continue
-        elif pathkey in pr_in_progress:
-                state = {'state': 'PULL_REQUEST', 'url': pr_in_progress[pathkey]}
-        elif filepath not in published_files:
-            state = 'UNPUBLISHED'
-        else:
-            if published_files[filepath] == sha:
-                state = 'PUBLISHED'
-            else:
-                state = 'MODIFIED'
         result[filepath] = state
         if 'state' in state:
             state = 'MODIFIED'
@@ -188,7 +513,107 @@ def get_publication_state():
             else:
                 result[parent_path][state] += 1
 
-    return dict(result)
+    return dict(result), pr_in_progress
+
+def get_file_publication_state(filepath, published_files, unpublished_files, pr_in_progress, may_publish_regex):
+    """
+    Returns the publication state of a file, or None if it has none
+    """
+    pathkey = filepath[:-5] if filepath.endswith('.json') else filepath
+    if filepath not in unpublished_files:
+        return None
+    elif not filepath.startswith('translation/'):
+        return None
+    elif not may_publish_regex.match(filepath):
+        return None
+    elif pathkey in pr_in_progress:
+        return {'state': 'PULL_REQUEST', 'url': pr_in_progress[pathkey]}
+    elif filepath not in published_files:
+        return 'UNPUBLISHED'
+    elif published_files[filepath] == unpublished_files[filepath]:
+        return 'PUBLISHED'
+    else:
+        return 'MODIFIED'
+
+class PublicationState:
+    """
+    The publication state of every publishable file, along with counts of
+    PUBLISHED, UNPUBLISHED and MODIFIED files for each directory above it
+
+    The state is kept for the published and unpublished commits it was
+    made for. When only those have moved, just the files which differ
+    between the old and new commits are reclassified, adjusting the counts
+    of their directories. Counts are replaced rather than modified, since
+    they are handed out as they are.
+    """
+    def __init__(self):
+        self.version = None
+        self.result = {}
+        self.pr_in_progress = {}
+        self._line_counts = (None, None)
+        self._lock = threading.Lock()
+
+    def get(self):
+        from permissions import get_rules_version
+        with self._lock:
+            version = (get_publication_version(), get_rules_version())
+            if self.version == version:
+                return self.result
+            if self.version and self.version[0][2] == version[0][2] and self.version[1] == version[1]:
+                try:
+                    self.update(self.version[0], version[0])
+                    self.version = version
+                    return self.result
+                except GitCommandError:
+                    logging.exception('Could not update publication state, rebuilding')
+            self.result, self.pr_in_progress = make_publication_state()
+            self.version = version
+            return self.result
+
+    def update(self, old_version, new_version):
+        changed = published.get_changed_files(old_version[0], new_version[0])
+        changed |= unpublished.get_changed_files(old_version[1], new_version[1])
+
+        published_files = published.get_file_map()
+        unpublished_files = unpublished.get_file_map()
+        from permissions import make_may_publish_regex
+        may_publish_regex = make_may_publish_regex()
+        for filepath in changed:
+            old_state = self.result.get(filepath)
+            new_state = get_file_publication_state(filepath, published_files, unpublished_files, self.pr_in_progress, may_publish_regex)
+            if old_state == new_state:
+                continue
+            if old_state is not None:
+                self.count(filepath, old_state, -1)
+                del self.result[filepath]
+            if new_state is not None:
+                self.count(filepath, new_state, 1)
+                self.result[filepath] = new_state
+
+    def count(self, filepath, state, delta):
+        if 'state' in state:
+            state = 'MODIFIED'
+        parts = pathlib.Path(filepath).parts
+        for i in range(0, len(parts)):
+            parent_path = '/'.join(parts[0:i])
+            if parent_path in self.pr_in_progress:
+                self.result[parent_path] = {'state': 'PULL_REQUEST', 'url': self.pr_in_progress[parent_path]}
+                continue
+            counts = dict(self.result.get(parent_path) or {'PUBLISHED':0, 'UNPUBLISHED': 0, 'MODIFIED': 0})
+            counts[state] += delta
+            if any(counts.values()):
+                self.result[parent_path] = counts
+            else:
+                del self.result[parent_path]
+
+    def get_line_counts(self):
+        with self._lock:
+            shas = (base_repo.commit('unpublished').hexsha, base_repo.commit('published').hexsha)
+            if self._line_counts[0] != shas:
+                self._line_counts = (shas, make_publication_line_counts())
+            return self._line_counts[1]
+
+publication_state = PublicationState()
 
 def create_publish_request(path, user):
     try:
@@ -229,7 +654,8 @@ def finalize_commit():
         except GitCommandError:
             print('Git push failed, attempting to pull and trying again')
             if i <= 1:
-                git.pull('-Xtheirs', kill_after_timeout=20)
+                with worktree_lock:
+                    git.pull('-Xtheirs', kill_after_timeout=20)
 
     else:
         print('Failure')
@@ -253,6 +679,8 @@ def finalizer_task_runner(interval):
                 finalize_commit()
 
 atexit.register(finalize_commit)
+# Registered later so it runs first
+atexit.register(commit_queue.join)
 
 def start_finalizer(interval):
     finalizer = threading.Thread(target=finalizer_task_runner, args=(interval,))
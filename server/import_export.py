@@ -1,5 +1,6 @@
 import fs
-from util import bilarasortkey
+import util
+from util import bilarasortkey, group_commit
 import io
 import pyexcel
 
@@ -48,7 +49,7 @@ def json_load(uid, suffix):
 
 def json_save(segment_data, uid, suffix):
     file = fs.get_file(fs._file_index[uid + '_' + suffix]["path"])
-    fs.json_save(segment_data, file)
+    util.json_save(segment_data, file)
 
 def get_data_for_uid(uid, suffixes=None):
     uids = list(iter_child_uids(uid))
@@ -103,24 +104,26 @@ def export_spreadsheet(uid, suffixes=None, format="ods"):
 
 
 def commit_data(uid, data):
-    for suffix, segment_data in data.items():
-        if not segment_data:
-            continue
-        try:
-            file_data = json_load(uid, suffix)
-        except FileNotFoundError:
-            print(f'File not found for {uid}_{suffix}, ignoring')
-            continue
-        # we compare with the existing data, if something is non-existing in the existing data
-        # and empty in the new data we don't add it to the file.
+    with group_commit():
+        for suffix, segment_data in data.items():
+            if not segment_data:
+                continue
+            try:
+                file_data = json_load(uid, suffix)
+            except FileNotFoundError:
+                print(f'File not found for {uid}_{suffix}, ignoring')
+                continue
+            # we compare with the existing data, if something is non-existing in the existing data
+            # and empty in the new data we don't add it to the file.
 
-        for k, v in list(segment_data.items()):
-            if not v and not file_data.get(k):
-                segment_data.pop(k)
-        
-        json_save(segment_data, uid, suffix)
+            for k, v in list(segment_data.items()):
+                if not v and not file_data.get(k):
+                    segment_data.pop(k)
+            
+            json_save(segment_data, uid, suffix)
         
 
+@group_commit()
 def load_sheet(filename):
     rows = pyexcel.iget_array(file_name=filename)
 
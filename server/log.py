@@ -63,6 +63,13 @@ class ProblemLogger:
         with self.file.open('w') as f:
             json.dump(entries, f, ensure_ascii=False, indent=2)
     
+    def get_version(self):
+        try:
+            stat = self.file.stat()
+            return (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return None
+
     def load(self):
         if self.file.exists():
             try:
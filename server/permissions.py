@@ -1,8 +1,12 @@
 
+import os
 import json
+import time
+import pathlib
 import regex
 import logging
 import threading
+from bisect import bisect_left
 from itertools import chain
 from log import problemsLog
 from enum import IntEnum
@@ -90,17 +94,74 @@ def build_rules(publications, projects):
             
 
 _cached_rules = {}
+_cached_matchers = {}
+_rules_checked_at = 0
+_rules_version = 0
+
+# Seconds between checks of the rules files' mtimes
+RULES_CHECK_INTERVAL = 1
 
 def get_rules(rebuild=False):
+    global _rules_checked_at
+    global _rules_version
+    now = time.monotonic()
+    if not rebuild and _cached_rules and now - _rules_checked_at < RULES_CHECK_INTERVAL:
+        return next(iter(_cached_rules.values()))
+    _rules_checked_at = now
     mtime = (publications_file.stat().st_mtime_ns, projects_file.stat().st_mtime_ns)
     rules = _cached_rules.get(mtime)
     if rebuild or not rules:
         _cached_rules.clear()
+        _cached_matchers.clear()
+        _rules_version += 1
         _cached_rules[mtime] = rules = build_rules(json_load(publications_file), json_load(projects_file))
         threading.Thread(target=validate_permissions, args=(rules,)).start()
     return rules
 
 
+def get_rules_version():
+    """
+    Returns a number which changes whenever the rules are rebuilt
+    """
+    get_rules()
+    return _rules_version
+
+
+def make_matcher(user_rules, default_rules):
+    """
+    Compile a user's rules into a list of (permission, regex) in order
+    of precedence. regex is None when the permission applies to every path.
+    """
+    matcher = []
+    for key in reversed(Permission):
+        if key is Permission.NONE:
+            continue
+        parts = user_rules[key] + default_rules[key]
+        if '*' in parts or not parts:
+            # An empty alternation matches everything
+            matcher.append((key, None))
+            break
+        matcher.append((key, regex.compile('|'.join(rf'\b{part}\b' for part in parts))))
+    return matcher
+
+
+def get_matcher(github_id):
+    """
+    Returns the compiled matcher for a user, or None if the user has no
+    rules. Matchers are built once per version of the rules.
+    """
+    # Read the version first, so a matcher built from rules which are
+    # replaced meanwhile is stored under the version it came from
+    key = (_rules_version, github_id)
+    rules = get_rules()
+    if github_id not in rules:
+        return None
+    matcher = _cached_matchers.get(key)
+    if matcher is None:
+        matcher = _cached_matchers[key] = make_matcher(rules[github_id], rules['*'])
+    return matcher
+
+
 def get_base_permissions(path, github_id):
     """
     Check what permissions a user has for a path
@@ -109,23 +170,15 @@ def get_base_permissions(path, github_id):
         github_id = github_id['login']
     path = str(path)
     
-    rules = get_rules()
+    matcher = get_matcher(github_id)
     
     result = Permission.VIEW
-    if github_id not in rules:
+    if matcher is None:
         return result
-        
     
-    for key in reversed(Permission):
-        if key is Permission.NONE:
-            continue
-        parts = rules[github_id][key] + rules['*'][key]
-        if '*' in parts:
+    for key, rex in matcher:
+        if rex is None or rex.search(path):
             return key
-        else:
-            rex = regex.compile('|'.join(rf'\b{part}\b' for part in parts))
-            if rex.search(path):
-                return key
     return result
 
 def get_permissions(path, github_id):
@@ -139,33 +192,83 @@ def get_permissions(path, github_id):
 
     return permission
 
+def get_permissions_bulk(paths, github_id):
+    """
+    Resolve the permissions for many paths at once, returning a dict of
+    path: Permission equivalent to calling get_permissions for each path
+
+    A rule which matches a directory also matches everything inside it,
+    so a path only needs to be checked against the permissions which
+    rank above the one resolved for its closest parent in paths. The
+    children of an editable directory are resolved without any matching.
+    """
+    if github_id and 'login' in github_id:
+        github_id = github_id['login']
+    matcher = get_matcher(github_id) or []
+
+    result = {}
+    # Stack of (path, index into matcher of the match, or len(matcher) for none)
+    parents = []
+    for path in sorted(paths, key=str):
+        base_path = str(path)
+        if 'comment' in base_path:
+            base_path = base_path.replace('comment', 'translation')
+
+        while parents and not base_path.startswith(parents[-1][0] + '/'):
+            parents.pop()
+        limit = parents[-1][1] if parents else len(matcher)
+
+        for i, (key, rex) in enumerate(matcher[:limit]):
+            if rex is None or rex.search(base_path):
+                break
+        else:
+            i = limit
+        parents.append((base_path, i))
+
+        permission = matcher[i][0] if i < len(matcher) else Permission.VIEW
+        if permission == Permission.SUGGEST:
+            permission = Permission.VIEW
+        result[path] = permission
+    return result
+
 def validate_permissions(rules=None):
     if not rules:
         rules = get_rules()
-    files = WORKING_DIR.glob('**/*.json')
-    files = [str(file.relative_to(WORKING_DIR)) 
-             for file in files 
-             if not any(part for part in file.parts if part.startswith('.'))]
+    files = []
+    for dirpath, dirnames, filenames in os.walk(WORKING_DIR):
+        # Don't descend into .git and other hidden folders
+        dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+        parent = pathlib.Path(dirpath).relative_to(WORKING_DIR)
+        files.extend(str(parent / name) for name in filenames
+                     if name.endswith('.json') and not name.startswith('.'))
+    files.sort()
 
+    checked = set()
     for user, user_permissions in rules.items():
         if user.startswith('_'):
             continue # Not a valid Github ID, used for bilara 
         for paths in user_permissions.values():
             for path in paths:
 
-                if path == '*':
+                if path == '*' or path in checked:
                     continue
-                for file in files:
-                    if file.startswith(path):
-                        break
-                else:
+                checked.add(path)
+                # Any file starting with path sorts at or just after it
+                i = bisect_left(files, path)
+                if i == len(files) or not files[i].startswith(path):
                     problemsLog.add(file=publications_file_name,
                                     msg=f"No files match path: {path}")
 
+_may_publish_regex = (None, None)
+
 def make_may_publish_regex():
+    global _may_publish_regex
     rules = get_rules()
-    paths = rules['_paths']
-    return regex.compile(r'^\L<paths>', paths=paths)
+    version = get_rules_version()
+    if _may_publish_regex[0] != version:
+        paths = rules['_paths']
+        _may_publish_regex = (version, regex.compile(r'^\L<paths>', paths=paths))
+    return _may_publish_regex[1]
 
 
 #    authors = json_load(WORKING_DIR / '_author.json')
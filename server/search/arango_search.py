@@ -4,6 +4,7 @@ from arango import ViewDeleteError
 import pathlib
 import json
 import itertools
+import collections
 import logging
 import regex
 
@@ -15,15 +16,17 @@ from config import WORKING_DIR, TM_ALIAS
 
 from log import problemsLog
 
+from util import legalize_key, make_string_docs_for_files, make_worker_pool, get_worker_count
+
 from .highlight import highlight_matching
 
-from permissions import get_permissions, Permission
+from permissions import get_permissions_bulk, Permission
 
 import fs
 
 
 
-from arango_common import get_db, import_background
+from arango_common import get_db, import_background, importer
 
 
 
@@ -195,6 +198,7 @@ class Search:
 
     def index(self, files=None, force=False):
         self._build_complete.clear()
+        importer.reset()
         print('TM Indexing Started')
         db = self.db
         collection_names = self.collection_names
@@ -216,23 +220,20 @@ class Search:
             self.collection_names = set()
 
         for collection_name, group in itertools.groupby(
-            self.yield_strings(files), lambda t: t[0]
+            self.parse_files(files), lambda t: t[0]
         ):
             if collection_name not in collection_names:
                 collection_names.add(collection_name)
             
-            for chunk in grouper((t[1] for t in group), 1000):
+            docs = itertools.chain.from_iterable(t[1] for t in group)
+            for chunk in grouper(docs, importer.batch_size):
                 if not db.has_collection(collection_name):
                     db.create_collection(collection_name)
                 
-                import_background(db[collection_name], chunk)
-                strings_chunk = []
-                for doc in chunk:
-                    _key = doc.pop('_key')
-                    doc['_key'] = f"{doc['muids']}_{doc['segment_id']}"
-                    strings_chunk.append(doc)
-                import_background(db['strings'], strings_chunk)
+                self.import_strings(collection_name, chunk)
         
+        importer.join()
+        print(f'Imported strings: {importer.get_stats()}')
         self.collection_names = collection_names
         print('Updating Search Views')
         self.create_search_view()
@@ -241,34 +242,67 @@ class Search:
 
         self._build_complete.set()
     
-    def update_partial(self, added=[], modified=[]):
-        if modified or added:
-            files = [WORKING_DIR / filepath for filepath in set(added).union(set(modified))]
-            files = [file for file in files if 
-                     file.suffix == '.json' and
-                     not any(part.startswith('.') for part in file.parts)]
-            self.index(files=files, force=False)
-
-    def files_removed(self, files_and_data):
-        for filepath, data in files_and_data:
+    def update_changes(self, old_sha, added=[], modified=[], removed=[]):
+        """
+        Bring the index up to date with the files changed since commit
+        old_sha. Each file is compared with its old version, so only the
+        strings which changed are imported and those which are gone are
+        removed.
+        """
+        from git_fs import read_file_at
+        added = set(added)
+        removed = set(removed)
+        collection_names = self.collection_names
+        new_files = []
+        for filepath in itertools.chain(added, modified, removed):
             file = WORKING_DIR / filepath
-            uid, muids = file.name.split('_')
-            
-            if not data:
-                logging.error('No data could be found for deleted file {filepath}')
+            if file.suffix != '.json' or any(part.startswith('.') for part in file.parts):
+                continue
+            uid, muids = file.stem.split('_') if '_' in file.stem else (None, None)
+            if not uid:
+                continue
+            if muids not in collection_names:
+                # The whole file needs indexing, along with a new collection
+                if filepath not in removed:
+                    new_files.append(file)
                 continue
-            self.db.collection[muids].delete_many([
-                {
-                    '_key': self.legalize_key(segment_id)
-                }
-                for segment_id in data
-            ])
-        
+
+            old_data = {} if filepath in added else self.load_strings(read_file_at(old_sha, filepath), file) or {}
+            if filepath in removed:
+                new_data = {}
+            else:
+                new_data = self.load_strings(file.read_text(encoding='utf8'), file)
+                if new_data is None:
+                    continue
+
+            changed = [
+                self.make_doc(segment_id, string, muids, file)
+                for segment_id, string in new_data.items()
+                if old_data.get(segment_id) != string
+            ]
+            for chunk in grouper(changed, importer.batch_size):
+                self.import_strings(muids, chunk)
+            self.remove_strings(muids, [segment_id for segment_id in old_data if segment_id not in new_data])
+
+        if new_files:
+            self.index(files=new_files, force=False)
+
+    def import_strings(self, collection_name, docs):
+        import_background(self.db[collection_name], docs)
+        # Copies, since the docs above may still be being imported
+        strings_chunk = [{**doc, '_key': f"{doc['muids']}_{doc['segment_id']}"} for doc in docs]
+        import_background(self.db['strings'], strings_chunk)
+
+    def remove_strings(self, muids, segment_ids):
+        if not segment_ids:
+            return
+        self.db[muids].delete_many([{'_key': self.legalize_key(segment_id)} for segment_id in segment_ids])
+        self.db['strings'].delete_many([{'_key': f"{muids}_{segment_id}"} for segment_id in segment_ids])
 
     @staticmethod
     def legalize_key(string):
         'Ensure that only legal characters are in the key, by replacing non-whitelisted characters with .'
-        return regex.sub(r"[^a-zA-Z0-9_:.@()+,=;$!*'%-]", '.', string)
+        return legalize_key(string)
 
     def iter_all_files(self):
         for folder in WORKING_DIR.iterdir():
@@ -279,39 +313,66 @@ class Search:
                     continue
                 yield file
 
-    def yield_strings(self, files):
-        for file in files:
-            if file.suffix != '.json':
-                continue
-            if '_' not in file.name:
-                logging.error(f'Invalid filename: {file}')
-                problemsLog.add(file=str(file.relative_to(WORKING_DIR)), msg=f'Not a valid filename: "_" missing')
-                continue
-            uid, muids = file.stem.split("_")
-            if not uid:
-                continue
+    def parse_files(self, files, chunk_size=16):
+        """
+        Yields (muids, docs) for each segment file in files, in order
 
-            with file.open("r") as f:
-                try:
-                    data = json.load(f)
-                except Exception as e:
-                    logging.error(f'Error loading file: {file}')
-                    problemsLog.add(file=str(file.relative_to(WORKING_DIR)), msg=f'JSON Decode Error on line {e.lineno}')
-                    continue
+        Files are parsed in a process pool, chunk_size at a time, with a
+        bounded number of chunks waiting to be consumed. A single chunk is
+        just parsed here.
+        """
+        chunks = grouper((file for file in files if file.suffix == '.json'), chunk_size)
+        first = next(chunks, None)
+        second = next(chunks, None)
+        if second is None:
+            results = make_string_docs_for_files(first or [], WORKING_DIR)
+            yield from self._check_parsed(first or [], results)
+            return
 
-            for segment_id, string in data.items():
-                if segment_id == "~":
-                    continue
-                yield (
-                    muids,
-                    {
-                        "_key": self.legalize_key(segment_id),
-                        "segment_id": segment_id,
-                        "string": string,
-                        "muids": muids,
-                        "filepath": str(file.relative_to(WORKING_DIR)),
-                    },
-                )
+        with make_worker_pool() as executor:
+            window = get_worker_count() * 4
+            pending = collections.deque()
+            for chunk in itertools.chain([first, second], chunks):
+                pending.append((chunk, executor.submit(make_string_docs_for_files, chunk, WORKING_DIR)))
+                if len(pending) >= window:
+                    chunk, future = pending.popleft()
+                    yield from self._check_parsed(chunk, future.result())
+            while pending:
+                chunk, future = pending.popleft()
+                yield from self._check_parsed(chunk, future.result())
+
+    def _check_parsed(self, files, results):
+        for file, (muids, docs, error) in zip(files, results):
+            if error:
+                logging.error(f'Error loading file: {file}')
+                problemsLog.add(file=str(file.relative_to(WORKING_DIR)), msg=error)
+            elif muids:
+                yield muids, docs
+
+    def load_strings(self, text, file):
+        """
+        Returns the strings of a segment file to index, or None if it
+        isn't valid
+        """
+        if text is None:
+            return None
+        try:
+            data = json.loads(text)
+        except Exception as e:
+            logging.error(f'Error loading file: {file}')
+            problemsLog.add(file=str(file.relative_to(WORKING_DIR)), msg=f'JSON Decode Error on line {e.lineno}')
+            return None
+        data.pop("~", None)
+        return data
+
+    def make_doc(self, segment_id, string, muids, file):
+        return {
+            "_key": self.legalize_key(segment_id),
+            "segment_id": segment_id,
+            "string": string,
+            "muids": muids,
+            "filepath": str(file.relative_to(WORKING_DIR)),
+        }
 
     def create_search_view(self):
         links = {}
@@ -527,8 +588,20 @@ class Search:
             'results': []
         }
 
+        entries = list(r)
+        matching_paths = {}
+        for entry in entries:
+            uid = entry['segment_id'].split(':')[0]
+            for key in entry:
+                if key == 'segment_id' or (uid, key) in matching_paths:
+                    continue
+                try:
+                    matching_paths[uid, key] = fs.get_matching_entry(uid, key.split('-'))['path']
+                except fs.NoMatchingEntry:
+                    matching_paths[uid, key] = None
+        permissions = get_permissions_bulk({path for path in matching_paths.values() if path}, user)
         
-        for entry in r:
+        for entry in entries:
             segment_id = entry['segment_id']
             uid = entry['segment_id'].split(':')[0]
 
@@ -536,12 +609,8 @@ class Search:
             for key, string in entry.items():
                 if key == 'segment_id':
                     continue
-                muids = key.split('-')
-                try:
-                    path = fs.get_matching_entry(uid, muids)
-                    permission = get_permissions(str(path), user)
-                except fs.NoMatchingEntry:
-                    permission = Permission.NONE
+                path = matching_paths[uid, key]
+                permission = permissions[path] if path else Permission.NONE
                 
                 segments[key] = {
                     'string': string,
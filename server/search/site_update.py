@@ -1,7 +1,7 @@
 import json
 import logging
 import pathlib
-from util import json_load, json_save, bilarasortkey
+from util import json_load, json_save, bilarasortkey, group_commit
 from arango_common import get_db
 from config import WORKING_DIR, CHECKOUTS_DIR
 from projects import get_projects
@@ -205,8 +205,9 @@ def rewrite_site_projects(files_and_data):
                 files_seen.add(file.relative_to(WORKING_DIR))
             parents_seen.add(parent_dir)
     
-    for file, data in files_and_data.items():
-        json_save(data, WORKING_DIR / file)
+    with group_commit():
+        for file, data in files_and_data.items():
+            json_save(data, WORKING_DIR / file)
     
     files_to_delete = files_seen.difference(files_and_data)
     print(f'{len(files_to_delete)} files to be deleted')
@@ -1,9 +1,14 @@
+import os
+import json
+import time
+import atexit
 import logging
+import pathlib
+import threading
 import git_fs
 from config import config
-from util import bilarasortkey
-from fs import get_file_path, get_file, get_parent_uid, is_id_legal
-from util import json_load, json_save
+from fs import get_file_path, get_file, get_parent_uid, is_id_legal, update_file_entry, segment_cache, sort_segment_ids
+from util import json_load, json_save, count_strings, ProcessJournal
 from permissions import Permission, get_permissions
 
 from concurrent.futures import ThreadPoolExecutor, wait
@@ -40,50 +45,256 @@ def update_segment(segment, user):
         logging.error('f"{long_id}" not found, {segment}')
         return {"error": "file not found"}
 
-    file = get_file(filepath)
-
     permission = get_permissions(filepath, user['login'])
     if permission != Permission.EDIT:
         logging.error("User not allowed to edit")
         return {"error": "Inadequate Permission"}
 
-    with git_fs._lock:
-        try:
-            file_data = json_load(file)
-        except FileNotFoundError:
-            file.parent.mkdir(parents=True, exist_ok=True)
-            file_data = {}
-        current_value = file_data.get(segment_id)
-        result = {}
-        if current_value and current_value != segment.get("oldValue"):
-            result["clobbered"] = current_value
+    try:
+        result = segment_writer.apply(filepath, parent_uid, segment, user)
+    except Exception:
+        logging.exception(f"could not write segment: {segment}")
+        return {"error": "could not write file"}
+
+    result["success"] = True
+    return result
+
+
+class SegmentWriter:
+    """
+    Write-behind buffer for segment edits
+
+    An edit is applied to an in-memory copy of its file and appended to an
+    fsync'd journal before being acknowledged. Every flush_delay seconds
+    the edited files are written to disk, once per file however many edits
+    it received, and queued for committing to git. Journalled edits which
+    never made it to disk are replayed by recover.
+
+    Each process keeps its own journal, so that a flush only ever moves
+    aside and removes edits it has buffered itself. recover replays the
+    journals of processes which have exited as well as its own.
+
+    Edits to a file are serialized by a lock for that file only, so saves
+    to different files and git operations don't wait on each other.
+    """
+    def __init__(self, journal_file, flush_delay):
+        self.journal = ProcessJournal(journal_file)
+        self.flush_delay = flush_delay
+        # filepath: {"data", "uid", "dirty", "edits": [(segment, user)]}
+        self._pending = {}
+        self._file_locks = {}
+        self._journal = None
+        self._lock = threading.Lock()
+        self._journal_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def get_lock(self, filepath):
+        with self._lock:
+            lock = self._file_locks.get(filepath)
+            if lock is None:
+                lock = self._file_locks[filepath] = threading.Lock()
+            return lock
+
+    def apply(self, filepath, uid, segment, user, journal=True):
+        """
+        Apply an edit, returning whether it changed the segment and the
+        value it clobbered, if any
+        """
+        file = get_file(filepath)
+        segment_id = segment["segmentId"]
+        with self.get_lock(filepath):
+            pending = self._pending.get(filepath)
+            if pending is None:
+                with git_fs.worktree_lock:
+                    try:
+                        data = json_load(file)
+                    except FileNotFoundError:
+                        data = {}
+                pending = {"data": data, "uid": uid, "dirty": False, "edits": []}
+                with self._lock:
+                    self._pending[filepath] = pending
+
+            current_value = pending["data"].get(segment_id)
+            result = {}
+            if current_value and current_value != segment.get("oldValue"):
+                result["clobbered"] = current_value
+
+            if current_value != segment["value"]:
+                result["changed"] = True
+
+            if journal:
+                self._write_journal({"filepath": filepath, "uid": uid, "segment": segment, "user": user})
+
+            pending["data"][segment_id] = segment["value"]
+            pending["dirty"] = True
+            pending["edits"].append((segment, user))
+            segment_cache.set_pending(file, dict(pending["data"]))
+        return result
+
+    @staticmethod
+    def get_flushing_file(journal_file):
+        return journal_file.with_name(f"{journal_file.name}.flushing")
 
-        if current_value != segment["value"]:
-            result["changed"] = True
+    def _write_journal(self, entry):
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        journal_file = self.journal.path
+        with self._journal_lock:
+            if self._journal is None or self._journal.name != str(journal_file):
+                self._journal = journal_file.open('a', encoding='utf8')
+            self._journal.write(line)
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
 
-        file_data[segment_id] = segment["value"]
+    def _rotate_journal(self):
+        """
+        Move the journal aside until the edits in it have been flushed
+        """
+        journal_file = self.journal.path
+        flushing_journal_file = self.get_flushing_file(journal_file)
+        with self._journal_lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            if not journal_file.exists():
+                return
+            if flushing_journal_file.exists():
+                # An earlier flush failed, so its edits are still needed
+                with flushing_journal_file.open('a', encoding='utf8') as f:
+                    f.write(journal_file.read_text(encoding='utf8'))
+                    f.flush()
+                    os.fsync(f.fileno())
+                journal_file.unlink()
+            else:
+                os.replace(journal_file, flushing_journal_file)
 
-        sorted_data = dict(sorted(file_data.items(), key=bilarasortkey))
+    def flush(self):
+        """
+        Write every edited file to disk and queue the git commits
+        """
+        with self._flush_lock:
+            # Every edit journalled before the rotation is in the buffer by
+            # the time the lock for its file is taken below
+            self._rotate_journal()
+            with self._lock:
+                filepaths = list(self._pending)
 
+            failed = False
+            for filepath in filepaths:
+                file = get_file(filepath)
+                with self.get_lock(filepath):
+                    pending = self._pending[filepath]
+                    if not pending["dirty"]:
+                        continue
+                    pending["dirty"] = False
+                    edits = pending["edits"][:]
+
+                try:
+                    # Apply the edits to the file as it is now rather than
+                    # writing out the buffer, which may be stale if other
+                    # processes have saved to the same file
+                    with git_fs.worktree_lock:
+                        try:
+                            data = json_load(file)
+                        except FileNotFoundError:
+                            file.parent.mkdir(parents=True, exist_ok=True)
+                            data = {}
+                        for segment, user in edits:
+                            data[segment["segmentId"]] = segment["value"]
+                        sorted_data = {k: data[k] for k in sort_segment_ids(pending["uid"], data)}
+                        json_save(sorted_data, file)
+                    segment_cache.invalidate(file)
+                    update_file_entry(filepath, count_strings(sorted_data))
+                except Exception:
+                    logging.exception(f"could not write segments to {filepath}")
+                    failed = True
+                    with self.get_lock(filepath):
+                        pending["dirty"] = True
+                    continue
+
+                with self.get_lock(filepath):
+                    del pending["edits"][:len(edits)]
+                    if not pending["dirty"]:
+                        with self._lock:
+                            del self._pending[filepath]
+                        segment_cache.clear_pending(file)
+
+                if config.GIT_COMMIT_ENABLED:
+                    for user in {user["login"]: user for segment, user in edits}.values():
+                        git_fs.commit_queue.put(filepath, user)
+                try:
+                    executor.submit(update_search, edits)
+                except RuntimeError:
+                    # Shutting down
+                    update_search(edits)
+
+            flushing_journal_file = self.get_flushing_file(self.journal.path)
+            if not failed and flushing_journal_file.exists():
+                flushing_journal_file.unlink()
+
+    def recover(self):
+        """
+        Replay the journalled edits which were not flushed before exiting
+
+        Edits left in this process's journal, by an earlier process with
+        the same pid, are still journalled. Those taken over from the
+        journals of other processes which have exited are journalled again
+        here before their journals are removed.
+        """
+        count = self._replay(self.journal.path, journal=False)
+        for journal_file in self.journal.orphans():
+            count += self._replay(journal_file, journal=True)
+        if count:
+            print(f'Replaying {count} journalled segment edits')
+            self.flush()
+
+    def _replay(self, journal_file, journal):
+        count = 0
+        for file in [self.get_flushing_file(journal_file), journal_file]:
+            if not file.exists():
+                continue
+            with file.open('r', encoding='utf8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.decoder.JSONDecodeError:
+                        # Torn write of the final entry
+                        continue
+                    self.apply(entry["filepath"], entry["uid"], entry["segment"], entry["user"], journal=journal)
+                    count += 1
+        return count
+
+    def has_pending(self):
+        with self._lock:
+            return any(pending["dirty"] for pending in self._pending.values())
+
+
+segment_writer = SegmentWriter(pathlib.Path('./.segment_journal'), config.get("SEGMENT_FLUSH_DELAY", 1))
+
+
+def flusher_task_runner(interval):
+    while True:
+        time.sleep(interval)
+        if not segment_writer.has_pending():
+            continue
         try:
-            json_save(sorted_data, file)
-            result["success"] = True
+            segment_writer.flush()
         except Exception:
-            logging.exception(f"could not write segment: {segment}")
-            return {"error": "could not write file"}
+            logging.exception("Segment flush failed")
 
-        executor.submit(background_update, filepath, user, segment)
-        return result
+atexit.register(segment_writer.flush)
 
-def background_update(filepath, user, segment):
-    try:
-        if config.GIT_COMMIT_ENABLED:
-            git_fs.update_file(filepath, user)
-    except Exception:
-        logging.exception("Git Commit Failed")
+def start_flusher(interval):
+    flusher = threading.Thread(target=flusher_task_runner, args=(interval,))
+    flusher.daemon = True
+    flusher.start()
+    return flusher
+
+_flusher = start_flusher(segment_writer.flush_delay)
 
-    try:
-        search.update_segment(segment)
-    except Exception:
-        logging.exception("Could not update TM for segment: {segment}")
 
+def update_search(edits):
+    for segment, user in edits:
+        try:
+            search.update_segment(segment)
+        except Exception:
+            logging.exception("Could not update TM for segment: {segment}")
@@ -1,6 +1,8 @@
 import os, pathlib
 import pytest
 
-os.chdir (pathlib.Path.cwd() / 'tests')
+if __name__ == "__main__":
+    # Process pool workers import __main__, they mustn't run the tests
+    os.chdir (pathlib.Path.cwd() / 'tests')
 
-pytest.main()
+    pytest.main()
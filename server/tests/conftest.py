@@ -0,0 +1,45 @@
+import json
+import pytest
+import fs
+import projects
+
+
+def write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(data))
+
+
+@pytest.fixture
+def corpus(tmp_path, monkeypatch):
+    write(tmp_path / '_category.json', {
+        'root': {'type': 'category', 'name': 'Root'},
+        'translation': {'type': 'category', 'name': 'Translation'},
+        'comment': {'type': 'category', 'name': 'Comment'},
+    })
+    write(tmp_path / '_project.json', {
+        'site-de': {
+            'root_path': 'root/en/site',
+            'translation_path': 'translation/de/site',
+            'translation_muids': 'translation-de-site',
+        }
+    })
+    write(tmp_path / 'root' / '_language.json', {
+        'pli': {'type': 'root_lang', 'name': 'Pali'},
+        'en': {'type': 'root_lang', 'name': 'English'},
+    })
+    write(tmp_path / 'root/pli/_edition.json', {'ms': {'type': 'root_edition', 'name': 'Mahāsaṅgīti'}})
+    write(tmp_path / 'translation/_language.json', {
+        'en': {'type': 'translation_lang', 'name': 'English'},
+        'de': {'type': 'translation_lang', 'name': 'German'},
+    })
+    write(tmp_path / 'root/pli/ms/sutta/dn/dn1_root-pli-ms.json', {'dn1:1.1': 'Evaṁ me sutaṁ', 'dn1:1.2': 'ekaṁ samayaṁ'})
+    write(tmp_path / 'root/pli/ms/sutta/dn/dn2_root-pli-ms.json', {'dn2:1.1': 'Evaṁ', 'dn2:1.2': ''})
+    write(tmp_path / 'translation/en/sujato/sutta/dn/dn1_translation-en-sujato.json', {'dn1:1.1': 'So I have heard'})
+    write(tmp_path / 'comment/en/sujato/sutta/dn/dn2_comment-en-sujato.json', {'dn2:1.1': 'note'})
+    write(tmp_path / 'root/en/site/menu_root-en-site.json', {'menu:1': 'Home'})
+
+    monkeypatch.setattr(fs, 'WORKING_DIR', tmp_path)
+    monkeypatch.setattr(projects, 'projects_file', tmp_path / '_project.json')
+    monkeypatch.setattr(fs, 'state_build_lock_file', tmp_path / '.saved_state.lock')
+    monkeypatch.setattr(fs, 'save_state', lambda: None)
+    return tmp_path
@@ -0,0 +1,45 @@
+import fs
+from .conftest import write
+
+
+def get_index():
+    return {name: getattr(fs, name) for name in (
+        '_tree_index',
+        '_uid_index',
+        '_muid_index',
+        '_file_index',
+        '_legal_ids',
+        '_special_uid_mapping',
+        '_segment_order',
+    )}
+
+
+def test_update_file_index_matches_full_build(corpus):
+    fs.make_file_index(force=True)
+
+    added = [
+        'root/pli/ms/sutta/mn/mn1_root-pli-ms.json',
+        'translation/en/sujato/sutta/mn/mn1_translation-en-sujato.json',
+        'root/en/site/help/faq_root-en-site.json',
+        'translation/de/site/home_translation-de-site.json',
+    ]
+    modified = ['root/pli/ms/sutta/dn/dn1_root-pli-ms.json']
+    removed = [
+        'translation/en/sujato/sutta/dn/dn1_translation-en-sujato.json',
+        'root/en/site/menu_root-en-site.json',
+    ]
+    write(corpus / added[0], {'mn1:1.1': 'Evaṁ me sutaṁ', 'mn1.2:1.1': 'ekaṁ samayaṁ'})
+    write(corpus / added[1], {'mn1:1.1': 'So I have heard'})
+    write(corpus / added[2], {'faq:1': 'Questions'})
+    write(corpus / added[3], {'home:1': 'Startseite'})
+    write(corpus / modified[0], {'dn1:1.1': 'Evaṁ me sutaṁ', 'dn1:1.3': 'ekaṁ samayaṁ', 'dn1.1:1': ''})
+    for filepath in removed:
+        (corpus / filepath).unlink()
+    # git removes folders left empty
+    (corpus / removed[0]).parent.rmdir()
+
+    fs.update_file_index(added, modified, removed)
+    updated = get_index()
+
+    fs.make_file_index(force=True)
+    assert updated == get_index()
@@ -0,0 +1,86 @@
+import threading
+import regex
+from git import Repo
+import git_fs
+import git_pr
+import permissions
+from git_branch import GitBranch
+
+
+def make_branch(repo, name):
+    branch = GitBranch.__new__(GitBranch)
+    branch.lock = threading.RLock()
+    branch.name = name
+    branch.repo = repo
+    return branch
+
+
+def commit(repo, path, branch, files):
+    "Commit files, a dict of filepath: contents or None to delete, to branch"
+    if repo.active_branch.name != branch:
+        repo.git.checkout(branch)
+    for filepath, contents in files.items():
+        if contents is None:
+            repo.git.rm(filepath)
+        else:
+            (path / filepath).parent.mkdir(parents=True, exist_ok=True)
+            (path / filepath).write_text(contents)
+            repo.git.add(filepath)
+    repo.git.commit(m=f'Update {branch}')
+    return repo.commit(branch).hexsha
+
+
+def test_update_publication_state_matches_full_build(tmp_path, monkeypatch):
+    repo = Repo.init(tmp_path)
+    repo.git.config('user.name', 'Test')
+    repo.git.config('user.email', 'test@example.com')
+    repo.git.symbolic_ref('HEAD', 'refs/heads/published')
+    published_sha = commit(repo, tmp_path, 'published', {
+        'translation/en/sujato/sutta/dn/dn1.json': 'dn1',
+        'translation/en/sujato/sutta/dn/dn2.json': 'dn2',
+        'translation/en/sujato/sutta/mn/mn1.json': 'mn1',
+    })
+    repo.git.checkout('-b', 'unpublished')
+    unpublished_sha = commit(repo, tmp_path, 'unpublished', {
+        'translation/en/sujato/sutta/dn/dn2.json': 'dn2 revised',
+        'translation/en/sujato/sutta/dn/dn3.json': 'dn3',
+        'translation/en/sujato/sutta/mn/mn2.json': 'mn2',
+        'translation/en/sujato/sutta/an/an1.json': 'an1',
+        'translation/de/sabbamitta/sutta/dn/dn1.json': 'dn1',
+        'root/pli/ms/sutta/dn/dn1.json': 'dn1',
+    })
+
+    monkeypatch.setattr(git_fs, 'published', make_branch(repo, 'published'))
+    monkeypatch.setattr(git_fs, 'unpublished', make_branch(repo, 'unpublished'))
+    monkeypatch.setattr(git_pr.pr_log, 'load', lambda: {
+        'mn': {'path': 'translation/en/sujato/sutta/mn', 'url': 'https://example.com/pr/1'},
+        'dn5': {'path': 'translation/en/sujato/sutta/dn/dn5', 'url': 'https://example.com/pr/2'},
+    })
+    monkeypatch.setattr(permissions, 'make_may_publish_regex', lambda: regex.compile(r'^translation/en/'))
+
+    state = git_fs.PublicationState()
+    state.result, state.pr_in_progress = git_fs.make_publication_state()
+
+    new_published_sha = commit(repo, tmp_path, 'published', {
+        'translation/en/sujato/sutta/dn/dn2.json': 'dn2 revised',
+        'translation/en/sujato/sutta/dn/dn4.json': 'dn4',
+    })
+    repo.git.checkout('unpublished')
+    repo.git.merge('published', m='Merge published')
+    new_unpublished_sha = commit(repo, tmp_path, 'unpublished', {
+        'translation/en/sujato/sutta/dn/dn1.json': 'dn1 revised',
+        'translation/en/sujato/sutta/dn/dn3.json': None,
+        'translation/en/sujato/sutta/dn/dn5.json': 'dn5',
+        'translation/en/sujato/sutta/mn/mn1.json': None,
+        'translation/en/sujato/sutta/mn/mn3.json': 'mn3',
+        'translation/en/sujato/sutta/sn/sn1.json': 'sn1',
+        'translation/en/sujato/sutta/an/an1.json': None,
+        'translation/de/sabbamitta/sutta/dn/dn1.json': None,
+    })
+
+    state.update((published_sha, unpublished_sha), (new_published_sha, new_unpublished_sha))
+    result, _ = git_fs.make_publication_state()
+    assert state.result == result
+    assert state.result['translation/en/sujato/sutta/dn'] == {'PUBLISHED': 2, 'UNPUBLISHED': 0, 'MODIFIED': 2}
+    assert 'translation/en/sujato/sutta/sn' in state.result
+    assert 'translation/en/sujato/sutta/an' not in state.result
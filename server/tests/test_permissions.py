@@ -167,4 +167,44 @@ def test_comment_permissions():
     filepath = 'comment/en/sujato/sutta/dn/dn1.json'
 
     assert permissions.get_permissions(filepath, 'sujato') == Permission.EDIT
-    assert permissions.get_permissions(filepath, 'brahmali') == Permission.VIEW
\ No newline at end of file
+    assert permissions.get_permissions(filepath, 'brahmali') == Permission.VIEW
+
+def test_make_matcher():
+    rules = permissions.build_rules(pubs, {})
+    matcher = permissions.make_matcher(rules['sujato'], rules['*'])
+
+    assert [key for key, rex in matcher] == [Permission.EDIT, Permission.SUGGEST]
+    assert matcher[0][1].search('translation/en/sujato/sutta/dn/dn1.json')
+    assert not matcher[0][1].search('translation/en/brahmali/vinaya/pli-tv-bu-vb-pj1.json')
+    assert matcher[-1][1] is None
+
+def test_get_permissions_bulk(monkeypatch):
+    rules = permissions.build_rules(pubs, {})
+    monkeypatch.setattr(permissions, 'get_rules', lambda rebuild=False: rules)
+    monkeypatch.setattr(permissions, '_cached_matchers', {})
+
+    sutta = 'translation/en/sujato/sutta'
+    paths = [
+        sutta,
+        f'{sutta}/dn',
+        f'{sutta}/dn/dn1.json',
+        f'{sutta}/dn-x',
+        f'{sutta}/dnx',
+        f'{sutta}/dnx/dnx1.json',
+        f'{sutta}/kn',
+        f'{sutta}/kn/thag/thag1.1.json',
+        f'{sutta}/kn/thig/thig1.1.json',
+        'comment/en/sujato/sutta/dn/dn1.json',
+        'root/pli/ms/sutta/dn/dn1.json',
+    ]
+
+    result = permissions.get_permissions_bulk(paths, 'sujato')
+    edit = {f'{sutta}/dn', f'{sutta}/dn/dn1.json', f'{sutta}/dn-x',
+            f'{sutta}/kn/thag/thag1.1.json', 'comment/en/sujato/sutta/dn/dn1.json'}
+    assert result == {path: Permission.EDIT if path in edit else Permission.VIEW for path in paths}
+
+    assert permissions.get_permissions_bulk(paths, 'brahmali') == dict.fromkeys(paths, Permission.VIEW)
+
+    for user in ['sujato', 'brahmali', 'bob', {'login': 'sujato'}]:
+        expected = {path: permissions.get_permissions(path, user) for path in paths}
+        assert permissions.get_permissions_bulk(paths, user) == expected
@@ -0,0 +1,77 @@
+import os
+import json
+from multiprocessing import get_context
+import pytest
+import fs
+import segment_updates
+from segment_updates import SegmentWriter
+
+filepath = 'translation/en/sujato/sutta/dn/dn1_translation-en-sujato.json'
+user = {'login': 'sujato', 'name': 'Sujato', 'email': 'sujato@example.com'}
+
+
+@pytest.fixture
+def journal_file(corpus, monkeypatch):
+    fs.make_file_index(force=True)
+    monkeypatch.setitem(segment_updates.config, 'GIT_COMMIT_ENABLED', False)
+    monkeypatch.setattr(segment_updates, 'update_search', lambda edits: None)
+    return corpus / '.segment_journal'
+
+
+def read(corpus):
+    return json.loads((corpus / filepath).read_text())
+
+
+def edit_and_exit(journal_file, exit_event):
+    "Journal an edit and exit without flushing it, as if crashing"
+    segment = {'segmentId': 'dn1:1.2', 'value': 'at one time', 'oldValue': ''}
+    writer = SegmentWriter(journal_file, 1)
+    writer.apply(filepath, 'dn1', segment, user)
+    exit_event.wait()
+
+
+# The child only journals an edit, so forking with idle background threads is safe
+@pytest.mark.filterwarnings('ignore:This process .* is multi-threaded:DeprecationWarning')
+def test_recover_journal_of_exited_process(journal_file, corpus):
+    context = get_context('fork')
+    exit_event = context.Event()
+    process = context.Process(target=edit_and_exit, args=(journal_file, exit_event))
+    process.start()
+    while not journal_file.with_name(f'{journal_file.name}.{process.pid}').exists():
+        assert process.is_alive()
+        process.join(0.01)
+
+    # The journal of a live process is left to it
+    writer = SegmentWriter(journal_file, 1)
+    writer.recover()
+    assert read(corpus) == {'dn1:1.1': 'So I have heard'}
+
+    exit_event.set()
+    process.join()
+    writer.recover()
+    assert read(corpus) == {'dn1:1.1': 'So I have heard', 'dn1:1.2': 'at one time'}
+    assert fs._file_index['dn1_translation-en-sujato']['count'] == 2
+    # Only the lock file of this process is left
+    assert [file.name for file in corpus.glob('.segment_journal*')] == [f'.segment_journal.{os.getpid()}.lock']
+
+
+def test_flush_leaves_journals_of_other_processes(journal_file, corpus):
+    other_journal_file = journal_file.with_name(f'{journal_file.name}.1')
+    entry = {'filepath': filepath, 'uid': 'dn1', 'segment': {'segmentId': 'dn1:1.2', 'value': 'at one time'}, 'user': user}
+    other_journal_file.write_text(json.dumps(entry) + '\n')
+
+    writer = SegmentWriter(journal_file, 1)
+    writer.apply(filepath, 'dn1', {'segmentId': 'dn1:1.1', 'value': 'Thus have I heard', 'oldValue': 'So I have heard'}, user)
+    writer.flush()
+    assert read(corpus) == {'dn1:1.1': 'Thus have I heard'}
+    assert other_journal_file.read_text() == json.dumps(entry) + '\n'
+
+
+def test_recover_journal_of_earlier_process_with_same_pid(journal_file, corpus):
+    segment = {'segmentId': 'dn1:1.2', 'value': 'at one time', 'oldValue': ''}
+    SegmentWriter(journal_file, 1).apply(filepath, 'dn1', segment, user)
+
+    writer = SegmentWriter(journal_file, 1)
+    writer.recover()
+    assert read(corpus) == {'dn1:1.1': 'So I have heard', 'dn1:1.2': 'at one time'}
+    assert [file.name for file in corpus.glob('.segment_journal*')] == [f'.segment_journal.{os.getpid()}.lock']
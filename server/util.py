@@ -1,5 +1,19 @@
+import io
+import os
+import glob
+import fcntl
 import json
+import random
+import pathlib
+import pstats
+import cProfile
+import functools
+import threading
 from log import logging
+from config import config
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 import regex
 
 def numericsortkey(string, _split=regex.compile(r'(\d+)').split):
@@ -49,25 +63,365 @@ def json_load(file):
             logging.error(file)
             raise e
 
+def count_strings(data):
+    """
+    Count the non-empty strings in segment data
+    """
+    count = 0
+    for k, v in data.items():
+        if k == "_meta":
+            continue
+        if v:
+            count += 1
+    return count
+
+def scan_segment_file(file):
+    """
+    Return the segment ids of a segment file, sorted with bilarasortkey,
+    and the number of non-empty
+    strings in it. This lives here rather than in fs so that process
+    pool workers don't have to import the whole app.
+    """
+    data = json_load(file)
+    try:
+        segment_ids = sorted(data, key=bilarasortkey)
+    except TypeError:
+        segment_ids = list(data)
+    return segment_ids, count_strings(data)
+
+def count_segment_file(file):
+    return count_strings(json_load(file))
+
+_illegal_key_chars = regex.compile(r"[^a-zA-Z0-9_:.@()+,=;$!*'%-]")
+
+def legalize_key(string):
+    'Ensure that only legal characters are in the key, by replacing non-whitelisted characters with .'
+    if _illegal_key_chars.search(string):
+        return _illegal_key_chars.sub('.', string)
+    return string
+
+def make_string_docs(file, working_dir):
+    """
+    Returns (muids, docs, error) for indexing the strings of a segment
+    file, where error describes why the file can't be indexed, if so
+    """
+    if '_' not in file.name:
+        return None, None, 'Not a valid filename: "_" missing'
+    uid, muids = file.stem.split("_")
+    if not uid:
+        return None, None, None
+    try:
+        data = json_load(file)
+    except Exception as e:
+        return None, None, f'JSON Decode Error on line {getattr(e, "lineno", None)}'
+
+    filepath = str(file.relative_to(working_dir))
+    docs = [
+        {
+            "_key": legalize_key(segment_id),
+            "segment_id": segment_id,
+            "string": string,
+            "muids": muids,
+            "filepath": filepath,
+        }
+        for segment_id, string in data.items()
+        if segment_id != "~"
+    ]
+    return muids, docs, None
+
+def make_string_docs_for_files(files, working_dir):
+    return [make_string_docs(file, working_dir) for file in files]
+
+def get_worker_count():
+    return config.get("INDEX_WORKERS") or os.cpu_count() or 1
+
+def make_worker_pool():
+    """
+    Returns a process pool of get_worker_count() workers for the functions
+    above
+
+    Forked workers could inherit locks held by the server's background
+    threads, so they're started from a fork server instead. Workers import
+    __main__, so scripts which use the pool must guard their entry point.
+    """
+    return ProcessPoolExecutor(max_workers=get_worker_count(), mp_context=get_context("forkserver"))
+
+def json_dumps(data):
+    """
+    Encode data as JSON the same way json_save always has
+
+    json.dumps can't use its C encoder when indenting, so segment files,
+    which are flat dicts of strings, are laid out here instead with each
+    string encoded by the C encoder.
+    """
+    if data and isinstance(data, dict) and all(isinstance(v, str) for v in data.values()):
+        encode = _flat_encoder.encode
+        return '{\n' + ',\n'.join(f'  {encode(k)}: {encode(v)}' for k, v in data.items()) + '\n}'
+    return json.dumps(data, ensure_ascii=False, indent=2)
+
+_flat_encoder = json.JSONEncoder(ensure_ascii=False)
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class GroupCommit:
+    """
+    Files saved by json_save inside group_commit, waiting to be renamed
+    into place
+
+    Each file is still synced on its own. Only the renames are deferred,
+    so that each directory is synced once per batch rather than per file.
+    """
+    def __init__(self, max_files):
+        self.max_files = max_files
+        self.files = []
+
+    def add(self, temp_file, file):
+        self.files.append((temp_file, file))
+        if len(self.files) >= self.max_files:
+            self.commit()
+
+    def commit(self):
+        if not self.files:
+            return
+        for temp_file, _ in self.files:
+            fsync_path(temp_file)
+        for temp_file, file in self.files:
+            os.replace(temp_file, file)
+        for directory in {file.parent for _, file in self.files}:
+            fsync_path(directory)
+        self.files = []
+
+    def discard(self):
+        "Remove the temp files of saves which couldn't be committed"
+        for temp_file, _ in self.files:
+            if temp_file.exists():
+                temp_file.unlink()
+        self.files = []
+
+_group_commit = threading.local()
+
+@contextmanager
+def group_commit(max_files=1000):
+    """
+    Defer the renaming of files saved by json_save in this thread
+
+    Each file keeps its old contents until the batch is committed, when
+    max_files have been saved or on leaving the outermost block, even
+    if it raises, as each file would have been saved without the batch.
+    """
+    if getattr(_group_commit, 'batch', None):
+        yield _group_commit.batch
+        return
+    batch = _group_commit.batch = GroupCommit(max_files)
+    try:
+        yield batch
+    finally:
+        _group_commit.batch = None
+        try:
+            batch.commit()
+        finally:
+            batch.discard()
+
 def json_save(data, file):
-    with file.open('w') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    """
+    Atomically replace file with data encoded as JSON
 
+    The data is written and synced to a temporary file in the same
+    directory which is then renamed over file, so that neither a crash nor
+    a concurrent reader ever sees a partially written file.
+    """
+    file = pathlib.Path(file)
+    temp_file = file.with_name(f'{file.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    batch = getattr(_group_commit, 'batch', None)
+    try:
+        with temp_file.open('w') as f:
+            f.write(json_dumps(data))
+            if not batch:
+                f.flush()
+                os.fsync(f.fileno())
+        if batch:
+            # The temp file name must stay unique until the batch commits
+            batch_temp_file = temp_file.with_name(f'{temp_file.name}.{len(batch.files)}')
+            os.replace(temp_file, batch_temp_file)
+            batch.add(batch_temp_file, file)
+        else:
+            os.replace(temp_file, file)
+            fsync_path(file.parent)
+    except BaseException:
+        if temp_file.exists():
+            temp_file.unlink()
+        raise
 
-def profile(sort_args=['cumulative'], print_args=[30]):
-    import cProfile
-    import pstats
 
-    profiler = cProfile.Profile()
+class ProcessJournal:
+    """
+    A journal of which each process keeps its own, named after journal_file
+    with the pid appended
 
-    def decorator(fn):
-        def inner(*args, **kwargs):
-            result = None
+    The owner holds an flock on a lock file beside its journal for as long
+    as it runs. The kernel releases the lock when the owner exits, so a
+    journal whose lock can be taken has been orphaned, and can be taken
+    over by another process through orphans.
+    """
+    # Lock files held open by this process, by path, shared by every
+    # instance since a second flock on the same file would wait forever
+    _owner_locks = {}
+    _owner_locks_lock = threading.Lock()
+
+    def __init__(self, journal_file):
+        self.journal_file = pathlib.Path(journal_file)
+
+    def get_file(self, pid, suffix=''):
+        return self.journal_file.with_name(f'{self.journal_file.name}.{pid}{suffix}')
+
+    @property
+    def path(self):
+        "The journal of this process"
+        pid = os.getpid()
+        lock_file = self.get_file(pid, '.lock')
+        with ProcessJournal._owner_locks_lock:
+            # Taken on first use, or in a process forked since
+            if lock_file not in ProcessJournal._owner_locks:
+                ProcessJournal._owner_locks[lock_file] = self._lock_file(lock_file, blocking=True)
+        return self.get_file(pid)
+
+    @staticmethod
+    def _lock_file(lock_file, blocking):
+        """
+        Returns lock_file open and locked, or None if it is locked by
+        another process or has gone
+        """
+        while True:
+            try:
+                f = lock_file.open('a' if blocking else 'r')
+            except FileNotFoundError:
+                return None
             try:
-                result = profiler.runcall(fn, *args, **kwargs)
+                fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                return None
+            try:
+                if os.stat(lock_file).st_ino == os.fstat(f.fileno()).st_ino:
+                    return f
+            except FileNotFoundError:
+                pass
+            # Removed by whoever took over its journal while we waited
+            f.close()
+            if not blocking:
+                return None
+
+    def orphans(self):
+        """
+        Yields the journals of processes which have exited, each locked
+        until the caller asks for the next one, at which point the files
+        of the journal are removed. A journal is left alone if the
+        caller raises while handling it.
+        """
+        prefix = f'{self.journal_file.name}.'
+        for lock_file in sorted(self.journal_file.parent.glob(f'{glob.escape(prefix)}*.lock')):
+            pid = lock_file.name[len(prefix):-len('.lock')]
+            if not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            f = self._lock_file(lock_file, blocking=False)
+            if f is None:
+                continue
+            with f:
+                journal = self.get_file(pid)
+                yield journal
+                for file in journal.parent.glob(f'{glob.escape(journal.name)}.*'):
+                    if file != lock_file:
+                        file.unlink()
+                if journal.exists():
+                    journal.unlink()
+                lock_file.unlink()
+
+
+class Profiling:
+    """
+    Runtime switchable profiling for functions decorated with profile
+
+    Profiling is off unless enabled in config or through the admin
+    endpoint. When on, a random sample_rate fraction of calls is run
+    under cProfile and the stats for each function are aggregated and
+    dumped to output_dir as <function>.prof.
+    """
+    def __init__(self, enabled=False, sample_rate=1.0, output_dir='log/profile'):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.output_dir = pathlib.Path(output_dir)
+        self.stats = {}
+        self.formats = {}
+        self._lock = threading.Lock()
+        # cProfile can't profile concurrent calls, so one at a time
+        self._active = threading.Lock()
+
+    def configure(self, enabled=None, sample_rate=None):
+        if enabled is not None:
+            self.enabled = bool(enabled)
+        if sample_rate is not None:
+            self.sample_rate = min(1.0, max(0.0, float(sample_rate)))
+
+    def reset(self):
+        with self._lock:
+            self.stats.clear()
+
+    def record(self, name, profiler):
+        with self._lock:
+            if name in self.stats:
+                self.stats[name].add(profiler)
+            else:
+                self.stats[name] = pstats.Stats(profiler)
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            self.stats[name].dump_stats(self.output_dir / f'{name}.prof')
+
+    def report(self):
+        result = {}
+        with self._lock:
+            for name, stats in self.stats.items():
+                sort_args, print_args = self.formats[name]
+                # strip_dirs changes the stats in place, so format a copy
+                stream = io.StringIO()
+                report = pstats.Stats(stream=stream).add(stats)
+                report.strip_dirs().sort_stats(*sort_args).print_stats(*print_args)
+                result[name] = stream.getvalue()
+        return result
+
+    def run(self, name, fn, *args, **kwargs):
+        if not self.enabled or random.random() >= self.sample_rate:
+            return fn(*args, **kwargs)
+        if not self._active.acquire(blocking=False):
+            return fn(*args, **kwargs)
+        try:
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(fn, *args, **kwargs)
             finally:
-                stats = pstats.Stats(profiler)
-                stats.strip_dirs().sort_stats(*sort_args).print_stats(*print_args)
-            return result
+                self.record(name, profiler)
+        finally:
+            self._active.release()
+
+
+profiling = Profiling(
+    enabled=config.get('PROFILING_ENABLED', False),
+    sample_rate=config.get('PROFILING_SAMPLE_RATE', 1.0),
+)
+
+
+def profile(sort_args=['cumulative'], print_args=[30]):
+    def decorator(fn):
+        name = f'{fn.__module__}.{fn.__qualname__}'
+        profiling.formats[name] = (sort_args, print_args)
+
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            return profiling.run(name, fn, *args, **kwargs)
         return inner
-    return decorator
\ No newline at end of file
+    return decorator